@@ -1,28 +1,26 @@
-import threading
-import pandas as pd
-import cv2
-import numpy as np
+import multiprocessing
 import os
-from tkinter import Tk, Button, Label, filedialog, messagebox, StringVar, Radiobutton, Entry
-
-# Function to convert RGB to LAB color space
-def rgb_to_lab(rgb):
-    try:
-        lab = cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2LAB)
-        return lab[0][0]
-    except Exception as e:
-        messagebox.showerror("Conversion Error", f"Failed to convert RGB to LAB: {e}")
-        return None
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ColorToThicknessCore import (IMAGE_EXTENSIONS, LOOKUP_TABLE_COLUMNS, SUBSTRATES, LazyModule, LookupTableStore, add_lookup_table_entry, instrumentation, main,
+                                  map_colors_to_thickness, map_image_flakes, remap_results_file, rgb_to_lab, roi_color_statistics)
+
+# Tkinter and OpenCV are imported on first use so the headless batch mode never loads them
+tk = LazyModule('tkinter')
+filedialog = LazyModule('tkinter.filedialog')
+messagebox = LazyModule('tkinter.messagebox')
+cv2 = LazyModule('cv2')
+
+# Number of worker threads running computations for the GUI
+MAX_WORKERS = 4
 
-# Function to normalize colors
-def normalize_colors(average_rgb, average_lab, background_rgb, background_lab):
-    try:
-        normalized_rgb = tuple(np.round(np.clip(np.array(average_rgb) / np.array(background_rgb), 0, 255), 5))
-        normalized_lab = tuple(np.round(np.clip(np.array(average_lab) / np.array(background_lab), 0, 255), 5))
-        return normalized_rgb, normalized_lab
-    except Exception as e:
-        messagebox.showerror("Normalization Error", f"Failed to normalize colors: {e}")
-        return None, None
+# Number of jobs that may be queued or running before new ones are refused
+MAX_PENDING_JOBS = 16
+
+# Interval at which the GUI collects finished jobs
+POLL_INTERVAL_MS = 100
 
 # Class to create the GUI application
 class App:
@@ -33,10 +31,11 @@ class App:
 
         self.function_choice = self.create_radiobutton_group("Functionality:", ["Lookup Table Entry", "Map Image to Lookup Table"], 0)
         self.entry_choice = self.create_radiobutton_group("Entry Method:", ["Manual Entry", "Image-Based Entry"], 1)
-        self.substrate_choice = self.create_radiobutton_group("Substrate Type:", ['Float', 'Borofloat', 'Si', 'D263'], 2, default='Float')
+        self.substrate_choice = self.create_radiobutton_group("Substrate Type:", SUBSTRATES, 2, default='Float')
 
         self.background_image_loaded = False
         self.goldflake_image_loaded = False
+        self.gold_flake_roi = None
 
         self.manual_entries = []
         self.background_rgb_entries = self.create_rgb_entries("Background RGB:", 4)
@@ -48,29 +47,37 @@ class App:
         self.background_image_button = self.create_button("Select Background Image", self.select_background_image, 3, 0)
         self.goldflake_image_button = self.create_button("Select Gold Flake Image", self.select_gold_flake_image, 3, 1)
 
-        self.thickness_label = Label(root, text="Enter Thickness [nm]:")
-        self.thickness_entry = Entry(root)
+        self.thickness_label = tk.Label(root, text="Enter Thickness [nm]:")
+        self.thickness_entry = tk.Entry(root)
 
-        self.create_button("Process", self.process_in_thread, 13, 0, colspan=3)
+        self.create_button("Process", self.process, 13, 0, colspan=3)
         self.create_button("Reset", self.reset_application, 14, 0, colspan=3)
         self.create_button("Remap Results", self.remap_results, 15, 0, colspan=3)
+        self.create_button("Map Flakes Automatically", self.map_flakes_automatically, 16, 0, colspan=3)
+
+        # Computations run on a bounded pool of workers and report back through a queue
+        # that the Tk main loop polls, so worker threads never touch the GUI
+        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        self.pending_jobs = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+        self.completed_jobs = queue.Queue()
+        self.root.after(POLL_INTERVAL_MS, self.poll_completed_jobs)
 
         self.update_entry_options()
 
     # Function to create radio button group
     def create_radiobutton_group(self, label_text, options, row, default=None):
-        Label(self.root, text=label_text).grid(row=row, column=0, padx=10, pady=10)
-        var = StringVar(self.root)
+        tk.Label(self.root, text=label_text).grid(row=row, column=0, padx=10, pady=10)
+        var = tk.StringVar(self.root)
         var.set(default if default else options[0])
         for i, option in enumerate(options):
-            Radiobutton(self.root, text=option, variable=var, value=option).grid(row=row, column=i + 1, padx=10, pady=10)
+            tk.Radiobutton(self.root, text=option, variable=var, value=option).grid(row=row, column=i + 1, padx=10, pady=10)
         var.trace_add('write', self.reset_on_mode_switch)
         return var
     
     # Function to create RGB entries
     def create_rgb_entries(self, label_text, row_start):
-        Label(self.root, text=label_text).grid(row=row_start, column=0, padx=10, pady=5, sticky="W")
-        entries = {color: Entry(self.root) for color in ["R", "G", "B"]}
+        tk.Label(self.root, text=label_text).grid(row=row_start, column=0, padx=10, pady=5, sticky="W")
+        entries = {color: tk.Entry(self.root) for color in ["R", "G", "B"]}
         for i, (color, entry) in enumerate(entries.items()):
             entry.grid(row=row_start + 1, column=i + 1, padx=5, pady=5)
             self.manual_entries.append(entry)
@@ -78,14 +85,14 @@ class App:
     
     # Function to create RGB label
     def create_rgb_label(self, label_text, row_start):
-        Label(self.root, text=label_text).grid(row=row_start, column=0, padx=10, pady=5, sticky="W")
-        label = Label(self.root, text="R: , G: , B: ", anchor="w")
+        tk.Label(self.root, text=label_text).grid(row=row_start, column=0, padx=10, pady=5, sticky="W")
+        label = tk.Label(self.root, text="R: , G: , B: ", anchor="w")
         label.grid(row=row_start + 1, column=0, padx=5, pady=5, sticky="W", columnspan=3)
         return label
     
     # Function to create button
     def create_button(self, text, command, row, col, colspan=1):
-        button = Button(self.root, text=text, command=command)
+        button = tk.Button(self.root, text=text, command=command)
         button.grid(row=row, column=col, padx=10, pady=10, columnspan=colspan)
         return button
 
@@ -151,121 +158,125 @@ class App:
             self.thickness_label.grid_remove()
             self.thickness_entry.grid_remove()
 
+    # Function to run a job on the worker pool and hand its result to a callback on the GUI thread
+    def submit(self, job, *args, on_success=None):
+        if not self.pending_jobs.acquire(blocking=False):
+            messagebox.showerror("Busy", "Too many jobs are running. Please wait for some of them to finish.")
+            return
+        future = self.executor.submit(job, *args)
+        future.add_done_callback(lambda future: self.completed_jobs.put((future, on_success)))
+
+    # Function to collect finished jobs on the GUI thread
+    def poll_completed_jobs(self):
+        while True:
+            try:
+                future, on_success = self.completed_jobs.get_nowait()
+            except queue.Empty:
+                break
+            self.pending_jobs.release()
+            try:
+                result = future.result()
+            except Exception as e:
+                messagebox.showerror("Processing Error", f"An error occurred during processing: {e}")
+                continue
+            if on_success is not None:
+                on_success(result)
+        self.root.after(POLL_INTERVAL_MS, self.poll_completed_jobs)
+
     # Function to select background image
     def select_background_image(self):
-        threading.Thread(target=self._select_background_image).start()
+        selection = self.select_image_roi()
+        if selection is not None:
+            self.submit(roi_color_statistics, *selection, on_success=self.set_background_colors)
 
-    # Function to select gold flake image
-    def _select_background_image(self):
-        self.background_rgb, self.background_lab = self.get_color_values(downscale=True)
-        if self.background_rgb is not None:
-            self.background_image_loaded = True
-            self.update_rgb_label(self.background_rgb_label, self.background_rgb)
+    # Function to store the background colors
+    def set_background_colors(self, colors):
+        self.background_rgb, self.background_lab, statistics = colors
+        self.background_image_loaded = True
+        self.update_rgb_label(self.background_rgb_label, self.background_rgb, statistics)
 
     # Function to select gold flake image
     def select_gold_flake_image(self):
-        threading.Thread(target=self._select_gold_flake_image).start()
-
-    # Function to select gold flake image
-    def _select_gold_flake_image(self):
-        self.gold_flake_rgb, self.gold_flake_lab = self.get_color_values(downscale=True)
-        if self.gold_flake_rgb is not None:
-            self.goldflake_image_loaded = True
-            self.update_rgb_label(self.goldflake_rgb_label, self.gold_flake_rgb)
-
-    # Function to update RGB label
-    def update_rgb_label(self, label, rgb_values):
-        label.config(text=f"R: {rgb_values[0]}, G: {rgb_values[1]}, B: {rgb_values[2]}")
-
-    # Function to process in thread
-    def process_in_thread(self):
-        threading.Thread(target=self.process).start()
+        selection = self.select_image_roi()
+        if selection is not None:
+            self.gold_flake_roi = selection[1]
+            self.submit(roi_color_statistics, *selection, on_success=self.set_gold_flake_colors)
+
+    # Function to store the gold flake colors
+    def set_gold_flake_colors(self, colors):
+        self.gold_flake_rgb, self.gold_flake_lab, statistics = colors
+        self.goldflake_image_loaded = True
+        self.update_rgb_label(self.goldflake_rgb_label, self.gold_flake_rgb, statistics)
+
+    # Function to update RGB label, with the spread of the ROI colors when they were measured on an image
+    def update_rgb_label(self, label, rgb_values, statistics=None):
+        text = f"R: {rgb_values[0]}, G: {rgb_values[1]}, B: {rgb_values[2]}"
+        if statistics is not None:
+            text += "".join(f"\n{name}: " + ", ".join(f"{value:.1f}" for value in statistics[f'{key}_rgb'])
+                            for name, key in [("Median", 'median'), ("Std", 'std'), ("Trimmed mean", 'trimmed_mean')])
+        label.config(text=text)
 
     # Function to process
     def process(self):
         try:
+            # Both functions need the colors of both images in image-based entry
+            if self.entry_choice.get() == "Image-Based Entry":
+                if not self.background_image_loaded or not self.goldflake_image_loaded:
+                    messagebox.showerror("Error", "Please select both background and gold flake images.")
+                    return
             if self.function_choice.get() == "Lookup Table Entry":
                 self.create_lookup_table_entry()
             else:
-                if self.entry_choice.get() == "Image-Based Entry":
-                    if not self.background_image_loaded or not self.goldflake_image_loaded:
-                        messagebox.showerror("Error", "Please select both background and gold flake images.")
-                        return
                 self.map_image_to_lookup_table()
         except Exception as e:
-            messagebox.showerror("Processing Error", f"An error occurred during processing: {e}")
-
-    # Function to get color values
-    def get_color_values(self, downscale=False):
-        image_path = filedialog.askopenfilename(title="Select an image", filetypes=[("Image files", "*.jpg *.jpeg *.png *.bmp")])
-        if not image_path:
-            messagebox.showerror("Error", "No image selected.")
-            return None, None
-
-        image = cv2.imread(image_path)
-
-        if downscale:
-            image = self.resize_image(image, max_size=400)  # Downscale to speed up operations
-
-        roi = select_roi_adjustable(image)
-        if roi is None:
-            messagebox.showerror("Error", "No ROI selected.")
-            return None, None
-
-        selected_area_rgb = image[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
-        selected_area_lab = cv2.cvtColor(selected_area_rgb, cv2.COLOR_BGR2LAB)
-
-        rgb = tuple(map(int, np.mean(selected_area_rgb, axis=(0, 1))))
-        lab = tuple(map(int, np.mean(selected_area_lab, axis=(0, 1))))
+            messagebox.showerror("Error", f"{e}")
+
+    # Function to select an image and an ROI on it
+    def select_image_roi(self):
+        with instrumentation.run('get_color_values'):
+            with instrumentation.stage('file_dialog'):
+                image_path = filedialog.askopenfilename(title="Select an image", filetypes=[("Image files", " ".join(f"*{extension}" for extension in IMAGE_EXTENSIONS))])
+            if not image_path:
+                messagebox.showerror("Error", "No image selected.")
+                return None
+
+            with instrumentation.stage('imread'):
+                image = cv2.imread(image_path)
+            if image is None:
+                messagebox.showerror("Error", f"Failed to read image '{image_path}'.")
+                return None
+
+            # The ROI is selected on a preview but measured on the full-resolution image
+            roi = select_roi_adjustable(image)
+            if roi is None:
+                messagebox.showerror("Error", "No ROI selected.")
+                return None
 
         self.selected_image_name = os.path.splitext(os.path.basename(image_path))[0]
 
-        return rgb, lab
+        return image, roi
 
-    # Function to resize image
-    def resize_image(self, image, max_size=800):
-        height, width = image.shape[:2]
-        if max(width, height) > max_size:
-            scale = max_size / max(width, height)
-            image = cv2.resize(image, (int(width * scale), int(height * scale)))
-        return image
+    # Function to get the gold flake and background colors from the entries or the selected images
+    def get_colors(self):
+        if self.entry_choice.get() == "Manual Entry":
+            background_rgb = self.get_rgb_from_entries(self.background_rgb_entries)
+            gold_flake_rgb = self.get_rgb_from_entries(self.goldflake_rgb_entries)
+            return gold_flake_rgb, tuple(map(int, rgb_to_lab(gold_flake_rgb))), background_rgb, tuple(map(int, rgb_to_lab(background_rgb)))
+        return self.gold_flake_rgb, self.gold_flake_lab, self.background_rgb, self.background_lab
 
     # Function to create lookup table entry
     def create_lookup_table_entry(self):
         substrate = self.substrate_choice.get()
-        file_name = f'lookup_table_{substrate}.csv'
-
-        lookup_table = pd.read_csv(file_name) if os.path.exists(file_name) else pd.DataFrame(columns=['R', 'G', 'B', 'L', 'a', 'b', 'Thickness [nm]'])
+        colors = self.get_colors()
 
-        if self.entry_choice.get() == "Manual Entry":
-            background_rgb = self.get_rgb_from_entries(self.background_rgb_entries)
-            gold_flake_rgb = self.get_rgb_from_entries(self.goldflake_rgb_entries)
-            background_lab = rgb_to_lab(background_rgb)
-            gold_flake_lab = rgb_to_lab(gold_flake_rgb)
-            normalized_rgb, normalized_lab = normalize_colors(gold_flake_rgb, gold_flake_lab, background_rgb, background_lab)
-        else:
-            normalized_rgb, normalized_lab = normalize_colors(self.gold_flake_rgb, self.gold_flake_lab, self.background_rgb, self.background_lab)
-        
         try:
             thickness = float(self.thickness_entry.get())
         except ValueError:
             messagebox.showerror("Error", "Please enter a valid thickness value.")
             return
-        
-        new_entry = pd.DataFrame({
-            'R': [normalized_rgb[0]], 'G': [normalized_rgb[1]], 'B': [normalized_rgb[2]],
-            'L': [normalized_lab[0]], 'a': [normalized_lab[1]], 'b': [normalized_lab[2]],
-            'Thickness [nm]': [thickness]
-        })
-
-        if all(column in lookup_table.columns for column in new_entry.columns):
-            lookup_table = pd.concat([lookup_table, new_entry], ignore_index=True)
-        else:
-            messagebox.showerror("Error", "Mismatch in DataFrame columns.")
-            return
 
-        lookup_table.to_csv(file_name, index=False)
-        messagebox.showinfo("Saved", f"Lookup table saved to '{file_name}'.")
+        self.submit(add_lookup_table_entry, substrate, *colors, thickness,
+                    on_success=lambda file_name: messagebox.showinfo("Saved", f"Lookup table saved to '{file_name}'."))
 
     # Function to get RGB from entries
     def get_rgb_from_entries(self, entries):
@@ -279,170 +290,95 @@ class App:
 
             return r, g, b
         except ValueError as e:
-            messagebox.showerror("Error", f"Please enter valid RGB values (0-255): {e}")
-            return None
+            raise ValueError(f"Please enter valid RGB values (0-255): {e}") from e
 
     # Function to close the application
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
+            self.executor.shutdown(wait=False, cancel_futures=True)
             self.root.destroy()
 
     # Function to map image to lookup table
     def map_image_to_lookup_table(self):
-        if self.entry_choice.get() == "Manual Entry":
-            background_rgb = self.get_rgb_from_entries(self.background_rgb_entries)
-            gold_flake_rgb = self.get_rgb_from_entries(self.goldflake_rgb_entries)
-            background_lab = rgb_to_lab(background_rgb)
-            gold_flake_lab = rgb_to_lab(gold_flake_rgb)
-        else:
-            background_rgb, background_lab = self.background_rgb, self.background_lab
-            gold_flake_rgb, gold_flake_lab = self.gold_flake_rgb, self.gold_flake_lab
-
+        colors = self.get_colors()
         substrate = self.substrate_choice.get()
-        file_name = f'lookup_table_{substrate}.csv'
         
-        if not os.path.exists(file_name):
+        if not LookupTableStore(substrate).exists():
             messagebox.showerror("Error", f"Lookup table for substrate '{substrate}' not found.")
             return
-        
-        lookup_table = pd.read_csv(file_name)
-
-        normalized_rgb, normalized_lab = normalize_colors(gold_flake_rgb, gold_flake_lab, background_rgb, background_lab)
-
-        thickness_rgb, match_type_rgb = self.find_closest_color(normalized_rgb, lookup_table, 'RGB')
-        thickness_lab, match_type_lab = self.find_closest_color(normalized_lab, lookup_table, 'LAB')
-
-        image_name = self.selected_image_name if self.entry_choice.get() == "Image-Based Entry" else "Manual Entry"
 
-        # Prepare notes for the results
-        note_rgb = match_type_rgb
-        note_lab = match_type_lab
-
-        results = pd.DataFrame({
-            'Image': [image_name],
-            'Substrate': [substrate],
-            'Average_RGB': [normalized_rgb],
-            'Average_LAB': [normalized_lab],
-            'Thickness_RGB [nm]': [thickness_rgb],
-            'Thickness_LAB [nm]': [thickness_lab],
-            'Note_RGB': [note_rgb],
-            'Note_LAB': [note_lab]
-        })
+        if self.entry_choice.get() == "Image-Based Entry":
+            image_name, roi = self.selected_image_name, self.gold_flake_roi
+        else:
+            image_name, roi = "Manual Entry", None
+        self.submit(map_colors_to_thickness, image_name, substrate, *colors, roi, on_success=self.show_mapping_result)
 
-        results_file = 'results.csv'
-        results.to_csv(results_file, mode='a' if os.path.exists(results_file) else 'w', header=not os.path.exists(results_file), index=False)
-        messagebox.showinfo("Results", f"Results saved to '{results_file}'.")
+    # Function to show the result of a mapping
+    def show_mapping_result(self, result):
+        messagebox.showinfo("Results", "Results saved to 'results.csv'.")
 
+        normalized_rgb = tuple(result[column] for column in LOOKUP_TABLE_COLUMNS[:3])
+        normalized_lab = tuple(result[column] for column in LOOKUP_TABLE_COLUMNS[3:6])
         results_text = f"Normalized RGB values: {normalized_rgb}\nNormalized LAB values: {normalized_lab}\n"
-        results_text += f"Mapped thickness for RGB: {thickness_rgb} nm ({note_rgb})\n"
-        results_text += f"Mapped thickness for LAB: {thickness_lab} nm ({note_lab})"
+        results_text += f"Mapped thickness for RGB: {result['Thickness_RGB [nm]']} nm ({result['Note_RGB']})\n"
+        results_text += f"Mapped thickness for LAB: {result['Thickness_LAB [nm]']} nm ({result['Note_LAB']})"
         messagebox.showinfo("Results", results_text)
 
-    # Function to remap results
-    def remap_results(self):
-        try:
-            results_file = 'results.csv'
-            if not os.path.exists(results_file):
-                messagebox.showerror("Error", f"No results file found. Please generate results first.")
-                return
-            
-            # Load the existing results
-            results = pd.read_csv(results_file)
-            
-            # Iterate over each row in the results to remap the thicknesses
-            updated_results = []
-            for index, row in results.iterrows():
-                normalized_rgb = tuple(map(float, row['Average_RGB'].strip('()').split(',')))
-                normalized_lab = tuple(map(float, row['Average_LAB'].strip('()').split(',')))
-
-                # Determine the substrate from the row, not from the current GUI selection
-                substrate = row['Substrate']
-                lookup_table_file = f'lookup_table_{substrate}.csv'
-                
-                if not os.path.exists(lookup_table_file):
-                    messagebox.showerror("Error", f"Lookup table for substrate '{substrate}' not found.")
-                    return
-                
-                lookup_table = pd.read_csv(lookup_table_file)
-
-                # Remap using the correct lookup table based on the stored substrate
-                thickness_rgb, match_type_rgb = self.find_closest_color(normalized_rgb, lookup_table, 'RGB')
-                thickness_lab, match_type_lab = self.find_closest_color(normalized_lab, lookup_table, 'LAB')
-
-                # Update only the thickness and notes in the results
-                updated_row = row.copy()
-                updated_row['Thickness_RGB [nm]'] = thickness_rgb
-                updated_row['Thickness_LAB [nm]'] = thickness_lab
-                updated_row['Note_RGB'] = match_type_rgb
-                updated_row['Note_LAB'] = match_type_lab
+    # Function to detect and map all flakes of an image without ROI selection
+    def map_flakes_automatically(self):
+        image_path = filedialog.askopenfilename(title="Select an image", filetypes=[("Image files", " ".join(f"*{extension}" for extension in IMAGE_EXTENSIONS))])
+        if not image_path:
+            messagebox.showerror("Error", "No image selected.")
+            return
 
-                updated_results.append(updated_row)
+        self.submit(map_image_flakes, image_path, self.substrate_choice.get(), on_success=self.show_flake_results)
 
-            # Consolidate results to remove any duplicates or near-identical entries
-            final_results = pd.DataFrame(updated_results).drop_duplicates()
+    # Function to show how many flakes were mapped
+    def show_flake_results(self, rows):
+        if not rows:
+            messagebox.showinfo("Results", "No flakes were detected.")
+        else:
+            messagebox.showinfo("Results", f"{len(rows)} flake(s) mapped and saved to 'results.csv'.")
 
-            # Save the updated and consolidated results back to the file
-            final_results.to_csv(results_file, index=False)
-            messagebox.showinfo("Success", "Results have been remapped and consolidated.")
-        
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to remap results: {e}")
+    # Function to remap results
+    def remap_results(self):
+        results_file = 'results.csv'
+        if not os.path.exists(results_file):
+            messagebox.showerror("Error", f"No results file found. Please generate results first.")
+            return
 
-    # Function to find closest color
-    def find_closest_color(self, color_value, lookup_table, color_space='RGB', threshold=5):
-        try:
-            if color_space == 'RGB':
-                diff = lookup_table[['R', 'G', 'B']] - color_value
-            else:
-                diff = lookup_table[['L', 'a', 'b']] - color_value
-            
-            distance = np.sqrt((diff**2).sum(axis=1))
-            min_distance = distance.min()
-            
-            # Find all closest matches
-            closest_indices = distance[distance == min_distance].index
-            thicknesses = lookup_table.loc[closest_indices, 'Thickness [nm]'].astype(str).tolist()
-            
-            # Determine match type
-            exact_match = False
-            if len(closest_indices) == 1:
-                closest_diff = diff.loc[closest_indices].iloc[0]
-                exact_match = (closest_diff == 0).all()
-            
-            # Multiple matches if more than one thickness is found
-            if len(thicknesses) > 1:
-                match_type = "Multiple matches"
-            elif exact_match:
-                match_type = "Exact match"
-            elif min_distance <= threshold:
-                match_type = "Approximate match"
-            else:
-                match_type = "No match"
-            
-            # Join thicknesses
-            thickness_str = "/".join(thicknesses)
-            
-            return thickness_str, match_type
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to find closest color: {e}")
-            return None, "Error"
+        # Remap the rows whose lookup table changed and drop the rows replaced by newer results, using all cores for large files
+        self.submit(remap_results_file, results_file, 100000, False, os.cpu_count() or 1,
+                    on_success=lambda _: messagebox.showinfo("Success", "Results have been remapped and consolidated."))
 
 # Function to select ROI adjustable
 def select_roi_adjustable(image):
     max_size = 800
     height, width = image.shape[:2]
-    if max(width, height) > max_size:
-        scale = max_size / max(width, height)
-        image = cv2.resize(image, (int(width * scale), int(height * scale)))
+    scale = min(1, max_size / max(width, height))
+    with instrumentation.stage('resize', width * height):
+        preview = cv2.resize(image, (int(width * scale), int(height * scale))) if scale < 1 else image
 
-    cv2.namedWindow('Select ROI', cv2.WINDOW_NORMAL)
-    cv2.resizeWindow('Select ROI', 800, 600)
-    roi = cv2.selectROI('Select ROI', image, fromCenter=False, showCrosshair=True)
-    cv2.destroyAllWindows()
+    with instrumentation.stage('select_roi'):
+        cv2.namedWindow('Select ROI', cv2.WINDOW_NORMAL)
+        cv2.resizeWindow('Select ROI', 800, 600)
+        roi = cv2.selectROI('Select ROI', preview, fromCenter=False, showCrosshair=True)
+        cv2.destroyAllWindows()
+
+    if roi == (0, 0, 0, 0):
+        return None
 
-    return roi if roi != (0, 0, 0, 0) else None
+    # Map the preview coordinates back to the full-resolution image
+    x0, y0 = min(int(round(roi[0] / scale)), width - 1), min(int(round(roi[1] / scale)), height - 1)
+    x1, y1 = min(int(round((roi[0] + roi[2]) / scale)), width), min(int(round((roi[1] + roi[3]) / scale)), height)
+    return x0, y0, max(x1 - x0, 1), max(y1 - y0, 1)
 
 if __name__ == "__main__":
-    root = Tk()
+    # Worker processes started by the frozen executable must run their task instead of the GUI or the batch mode
+    multiprocessing.freeze_support()
+    # Arguments run the headless batch mode instead of the GUI
+    if len(sys.argv) > 1:
+        sys.exit(main())
+    root = tk.Tk()
     app = App(root)
     root.mainloop()
\ No newline at end of file
@@ -1,34 +1,41 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# pandas, OpenCV, SciPy and the Tkinter dialogs are imported lazily by name, so they are listed explicitly
+hiddenimports = ['pandas', 'cv2', 'scipy.spatial', 'tkinter.filedialog', 'tkinter.messagebox']
+
+# Packages that are never used but get pulled in by the dependencies of pandas and SciPy
+excludes = [
+    'matplotlib', 'IPython', 'jedi', 'notebook', 'nbformat', 'pytest', 'sphinx', 'docutils',
+    'PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'sqlalchemy', 'openpyxl', 'lxml', 'pyarrow', 'numba',
+    'scipy.optimize', 'scipy.integrate', 'scipy.signal', 'scipy.stats', 'scipy.io', 'scipy.ndimage',
+]
 
 a = Analysis(
     ['ColorToThickness.py'],
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=hiddenimports,
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=excludes,
     noarchive=False,
     optimize=0,
 )
 pyz = PYZ(a.pure)
 
+# A one-folder build starts without unpacking the whole bundle to a temporary directory on every launch
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='ColorToThickness',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -36,3 +43,14 @@ exe = EXE(
     codesign_identity=None,
     entitlements_file=None,
 )
+
+# UPX is disabled because decompressing the libraries at every start costs more time than it saves on disk
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='ColorToThickness',
+)
@@ -0,0 +1,1538 @@
+import argparse
+import cProfile
+import errno
+import glob
+import importlib
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import os
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# Class to defer importing a module until one of its attributes is first used
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        # The import lock makes the first import safe from several threads
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+# Heavy modules are only imported once a computation needs them, which keeps startup fast
+pd = LazyModule('pandas')
+cv2 = LazyModule('cv2')
+spatial = LazyModule('scipy.spatial')
+
+# Function to convert RGB to LAB color space
+def rgb_to_lab(rgb):
+    try:
+        lab = cv2.cvtColor(np.uint8([[rgb]]), cv2.COLOR_RGB2LAB)
+        return lab[0][0]
+    except Exception as e:
+        raise ValueError(f"Failed to convert RGB to LAB: {e}") from e
+
+# Function to convert an array of RGB colors to LAB color space in a single call
+def rgb_to_lab_array(colors, bgr=False, precise=True):
+    colors = np.asarray(colors).reshape(-1, 1, 3)
+    code = cv2.COLOR_BGR2LAB if bgr else cv2.COLOR_RGB2LAB
+    if not precise:
+        # Same 8-bit conversion as rgb_to_lab, rounded to integers
+        return cv2.cvtColor(np.clip(np.round(colors), 0, 255).astype(np.uint8), code).reshape(-1, 3).astype(np.float32)
+
+    # Float conversion rescaled to the 8-bit LAB ranges the lookup tables use, without rounding
+    lab = cv2.cvtColor(colors.astype(np.float32) / 255, code).reshape(-1, 3)
+    return (lab * np.float32([255 / 100, 1, 1]) + np.float32([0, 128, 128])).astype(np.float32)
+
+# Function to normalize colors
+def normalize_colors(average_rgb, average_lab, background_rgb, background_lab):
+    try:
+        normalized_rgb = tuple(map(float, np.round(np.clip(np.array(average_rgb) / np.array(background_rgb), 0, 255), 5)))
+        normalized_lab = tuple(map(float, np.round(np.clip(np.array(average_lab) / np.array(background_lab), 0, 255), 5)))
+        return normalized_rgb, normalized_lab
+    except Exception as e:
+        raise ValueError(f"Failed to normalize colors: {e}") from e
+
+# Substrates with their own lookup table
+SUBSTRATES = ['Float', 'Borofloat', 'Si', 'D263']
+
+# Image file types accepted by the file dialog and the batch mode
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# Columns of a substrate lookup table
+LOOKUP_TABLE_COLUMNS = ['R', 'G', 'B', 'L', 'a', 'b', 'Thickness [nm]']
+
+# Memory cap of the in-process lookup table cache, configurable from the environment
+LOOKUP_CACHE_MAX_BYTES = int(os.environ.get('COLOR_TO_THICKNESS_CACHE_BYTES', 512 * 1024 * 1024))
+
+# Largest TIFF, in pixels, that automatic flake detection reads into memory, configurable from the environment
+AUTO_MAX_PIXELS = int(os.environ.get('COLOR_TO_THICKNESS_AUTO_MAX_PIXELS', 100 * 1000 * 1000))
+
+# Match types reported by find_closest_color, in the order used for match codes
+MATCH_TYPES = ("Exact match", "Approximate match", "Multiple matches", "No match")
+
+# Function to normalize an array of colors against one background reference or one per color
+def normalize_color_array(colors, background):
+    colors = np.asarray(colors, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(np.clip(colors / np.asarray(background, dtype=np.float64), 0, 255), 5)
+
+# Function to build lookup table entries from many calibration measurements at once
+def lookup_table_entries(gold_flake_rgb, background_rgb, thickness, precise=False):
+    gold_flake_rgb = np.asarray(gold_flake_rgb, dtype=np.float64).reshape(-1, 3)
+    background_rgb = np.broadcast_to(np.asarray(background_rgb, dtype=np.float64), gold_flake_rgb.shape)
+    normalized_rgb = normalize_color_array(gold_flake_rgb, background_rgb)
+    normalized_lab = normalize_color_array(rgb_to_lab_array(gold_flake_rgb, precise=precise), rgb_to_lab_array(background_rgb, precise=precise))
+
+    entries = pd.DataFrame(np.hstack([normalized_rgb, normalized_lab]), columns=LOOKUP_TABLE_COLUMNS[:6])
+    entries['Thickness [nm]'] = np.broadcast_to(np.asarray(thickness, dtype=np.float64), len(entries))
+    return entries
+
+# Class to answer closest color queries against a prebuilt KD-tree of a lookup table
+class LookupIndex:
+    def __init__(self, lookup_table, color_space='RGB', candidates=8):
+        columns = ['R', 'G', 'B'] if color_space == 'RGB' else ['L', 'a', 'b']
+        table = lookup_table[columns].to_numpy(dtype=np.float64)
+        rows = np.flatnonzero(~np.isnan(table).any(axis=1))
+
+        # Entries sharing a color collapse into one point that remembers its rows
+        self.points, inverse = np.unique(table[rows], axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        self.counts = np.bincount(inverse, minlength=len(self.points))
+        self.thickness_sum = np.bincount(inverse, weights=lookup_table['Thickness [nm]'].to_numpy(dtype=np.float64)[rows], minlength=len(self.points))
+        self.point_rows = np.split(rows[np.argsort(inverse, kind='stable')], np.cumsum(self.counts)[:-1])
+        self.thickness_text = lookup_table['Thickness [nm]'].astype(str).to_numpy()
+        self.point_text = np.array(["/".join(self.thickness_text[point_rows]) for point_rows in self.point_rows], dtype=object)
+        self.candidates = candidates
+        self.tree = spatial.cKDTree(self.points) if len(self.points) else None
+
+        # Rough footprint used by the lookup table cache, counting the tree as twice its points
+        self.nbytes = 3 * self.points.nbytes + self.counts.nbytes + self.thickness_sum.nbytes + 64 * (len(self.thickness_text) + len(self.point_text)) + sum(rows.nbytes for rows in self.point_rows)
+
+    # Function to find the closest points among the k nearest KD-tree candidates
+    def _nearest(self, colors, k):
+        k = min(k, len(self.points))
+        _, candidates = self.tree.query(colors, k=k)
+        candidates = candidates.reshape(len(colors), k)
+
+        # Distances are recomputed exactly so that equidistant entries tie
+        distance = np.sqrt(((self.points[candidates] - colors[:, None, :]) ** 2).sum(axis=2))
+        min_distance = distance.min(axis=1)
+        ties = distance == min_distance[:, None]
+
+        # A tie on the farthest candidate means further equidistant points may exist
+        widen = ties[:, -1] & (k < len(self.points))
+        return candidates, ties, min_distance, widen
+
+    # Function to resolve the closest points of each color, with ties
+    def _closest(self, colors):
+        candidates, ties, min_distance, widen = self._nearest(colors, self.candidates)
+        count = np.where(ties, self.counts[candidates], 0).sum(axis=1)
+        total = np.where(ties, self.thickness_sum[candidates], 0).sum(axis=1)
+        closest = candidates[np.arange(len(candidates)), ties.argmax(axis=1)]
+        tied = {row: candidates[row][ties[row]] for row in np.flatnonzero(ties.sum(axis=1) > 1)}
+
+        if widen.any():
+            rows = np.flatnonzero(widen)
+            candidates, ties, min_distance[rows], _ = self._nearest(colors[rows], len(self.points))
+            count[rows] = np.where(ties, self.counts[candidates], 0).sum(axis=1)
+            total[rows] = np.where(ties, self.thickness_sum[candidates], 0).sum(axis=1)
+            tied.update((row, row_candidates[row_ties]) for row, row_candidates, row_ties in zip(rows, candidates, ties))
+
+        return min_distance, count, total, closest, tied
+
+    # Function to classify matches the same way find_closest_color does
+    def _match_codes(self, min_distance, count, threshold):
+        return np.select(
+            [count > 1, min_distance == 0, min_distance <= threshold],
+            [MATCH_TYPES.index("Multiple matches"), MATCH_TYPES.index("Exact match"), MATCH_TYPES.index("Approximate match")],
+            default=MATCH_TYPES.index("No match")).astype(np.uint8)
+
+    # Function to query numeric thicknesses, distances and match codes for many colors
+    def query(self, colors, threshold=5):
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        if self.tree is None or len(colors) == 0:
+            return np.full(len(colors), np.nan), np.full(len(colors), np.nan), np.full(len(colors), MATCH_TYPES.index("No match"), dtype=np.uint8)
+
+        min_distance, count, total, _, _ = self._closest(colors)
+
+        # Equidistant entries are averaged and flagged as multiple matches
+        return total / count, min_distance, self._match_codes(min_distance, count, threshold)
+
+    # Function to query "/"-joined thicknesses and match types for many colors
+    def query_text(self, colors, threshold=5):
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        if self.tree is None or len(colors) == 0:
+            return np.full(len(colors), "", dtype=object), np.full(len(colors), "No match", dtype=object)
+
+        min_distance, count, _, closest, tied = self._closest(colors)
+        thickness = self.point_text[closest]
+
+        # Equidistant colors list the thicknesses of all their entries in table order
+        for row, points in tied.items():
+            rows = np.sort(np.concatenate([self.point_rows[point] for point in points]))
+            thickness[row] = "/".join(self.thickness_text[rows])
+
+        return thickness, np.array(MATCH_TYPES, dtype=object)[self._match_codes(min_distance, count, threshold)]
+
+# Function to find the closest lookup table colors for many colors at once
+def find_closest_colors(colors, lookup_table, color_space='RGB', threshold=5):
+    index = lookup_table if isinstance(lookup_table, LookupIndex) else LookupIndex(lookup_table, color_space)
+    return index.query(colors, threshold)
+
+# Function to find the closest lookup table color, joining the thicknesses of equidistant entries with "/"
+def find_closest_color(color_value, lookup_table, color_space='RGB', threshold=5):
+    index = lookup_table if isinstance(lookup_table, LookupIndex) else LookupIndex(lookup_table, color_space)
+    thickness, match_type = index.query_text([color_value], threshold)
+    return thickness[0], match_type[0]
+
+# Function to split match codes into one boolean mask per match type
+def match_type_masks(match):
+    return {match_type: match == code for code, match_type in enumerate(MATCH_TYPES)}
+
+# Function to find the distinct colors of an image and the position of each pixel's color among them
+def distinct_image_colors(image):
+    # Channels are used in the order cv2.imread returns them, as in get_color_values,
+    # so the per-pixel values agree with the ROI averages stored in the lookup tables
+    image = np.ascontiguousarray(image[..., :3], dtype=np.uint8)
+
+    # A pixel can only take 2^24 values, so each distinct color is mapped once
+    codes = (image[..., 0].astype(np.uint32) << 16) | (image[..., 1].astype(np.uint32) << 8) | image[..., 2]
+    seen = np.zeros(1 << 24, dtype=bool)
+    seen[codes] = True
+    present = np.flatnonzero(seen)
+    del seen
+
+    position = np.zeros(1 << 24, dtype=np.int32)
+    position[present] = np.arange(len(present), dtype=np.int32)
+    unique_colors = np.stack([present >> 16, (present >> 8) & 255, present & 255], axis=1).astype(np.uint8)
+    return unique_colors, position[codes]
+
+# Function to map every pixel of an image to a thickness
+def map_image_to_thickness(image, background_rgb, background_lab, lookup_table, threshold=5):
+    # Accepts a lookup table or the (RGB, LAB) index pair returned by load_lookup_indexes
+    if isinstance(lookup_table, tuple):
+        index_rgb, index_lab = lookup_table
+    else:
+        index_rgb, index_lab = LookupIndex(lookup_table, 'RGB'), LookupIndex(lookup_table, 'LAB')
+
+    unique_colors, index = distinct_image_colors(image)
+    normalized_rgb = normalize_color_array(unique_colors, background_rgb)
+    normalized_lab = normalize_color_array(rgb_to_lab_array(unique_colors, bgr=True, precise=False), background_lab)
+
+    thickness_rgb, distance_rgb, match_rgb = index_rgb.query(normalized_rgb, threshold)
+    thickness_lab, distance_lab, match_lab = index_lab.query(normalized_lab, threshold)
+
+    # Scatter the per-color results back to full resolution
+    return {
+        'thickness_rgb': thickness_rgb.astype(np.float32)[index],
+        'thickness_lab': thickness_lab.astype(np.float32)[index],
+        'distance_rgb': distance_rgb.astype(np.float32)[index],
+        'distance_lab': distance_lab.astype(np.float32)[index],
+        'match_rgb': match_rgb[index],
+        'match_lab': match_lab[index],
+    }
+
+# Smallest confidence scale of a thickness model, about one 8-bit level of a mid-gray background in normalized color units
+MODEL_SCALE_FLOOR = 0.01
+
+# Class to interpolate thickness continuously along the color trajectory of a lookup table
+class ThicknessModel:
+    def __init__(self, knot_thickness, knot_colors, scale, color_space='RGB', grid=None):
+        self.knot_thickness = np.asarray(knot_thickness, dtype=np.float64)
+        self.knot_colors = np.asarray(knot_colors, dtype=np.float64).reshape(-1, 3)
+        self.scale = float(scale)
+        self.color_space = color_space
+
+        if len(self.knot_colors) > 1:
+            self.start = self.knot_colors[:-1]
+            self.direction = self.knot_colors[1:] - self.start
+            self.length = np.maximum((self.direction ** 2).sum(axis=1), 1e-12)
+            if grid is None:
+                self._build_grid()
+            else:
+                self.grid_low, self.grid_step, self.grid_segment = grid
+
+    # Function to precompute the closest trajectory segment of every cell of a color grid
+    def _build_grid(self, resolution=64):
+        low, high = self.knot_colors.min(axis=0), self.knot_colors.max(axis=0)
+        margin = np.maximum(high - low, 1e-3) / 2
+        self.grid_low = low - margin
+        self.grid_step = (high - low + 2 * margin) / resolution
+
+        # Dense samples along the trajectory give the closest segment of each cell center
+        steps = np.arange(16) / 16
+        samples = self.start[:, None, :] + steps[None, :, None] * self.direction[:, None, :]
+        sample_segment = np.repeat(np.arange(len(self.start)), len(steps))
+        axes = [self.grid_low[channel] + (np.arange(resolution) + 0.5) * self.grid_step[channel] for channel in range(3)]
+        centers = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        _, sample = spatial.cKDTree(samples.reshape(-1, 3)).query(centers)
+        self.grid_segment = sample_segment[sample].reshape(resolution, resolution, resolution)
+
+    # Function to fit a piecewise-linear color trajectory with a fixed number of knots
+    @classmethod
+    def fit(cls, lookup_table, color_space='RGB', knots=128):
+        columns = ['R', 'G', 'B'] if color_space == 'RGB' else ['L', 'a', 'b']
+        table = lookup_table[columns + ['Thickness [nm]']].dropna()
+        if table.empty:
+            raise ValueError("Cannot fit a thickness model to an empty lookup table.")
+
+        # Entries measured at the same thickness are averaged into one point of the trajectory
+        trajectory = table.groupby('Thickness [nm]')[columns].mean()
+        thickness = trajectory.index.to_numpy(dtype=np.float64)
+        knot_thickness = thickness if len(thickness) <= knots else np.linspace(thickness[0], thickness[-1], knots)
+        knot_colors = np.stack([np.interp(knot_thickness, thickness, trajectory[column].to_numpy()) for column in columns], axis=1)
+
+        # Confidence is expressed in units of the calibration scatter around the trajectory
+        model = cls(knot_thickness, knot_colors, 1, color_space)
+        _, distance = model._project(table[columns].to_numpy(dtype=np.float64))
+        model.scale = max(np.sqrt(np.mean(distance ** 2) + np.mean(cls._leave_one_out_distances(trajectory.to_numpy()) ** 2)), MODEL_SCALE_FLOOR)
+        return model
+
+    # Function to measure how far each inner trajectory point lies from the segment joining its neighbours
+    @staticmethod
+    def _leave_one_out_distances(points):
+        # Knots placed on the table rows hide the scatter, leaving each point out shows it
+        if len(points) < 3:
+            return np.zeros(1)
+        start, point, direction = points[:-2], points[1:-1], points[2:] - points[:-2]
+        position = np.clip((((point - start) * direction).sum(axis=1) / np.maximum((direction ** 2).sum(axis=1), 1e-12)), 0, 1)
+        return np.sqrt(((point - start - position[:, None] * direction) ** 2).sum(axis=1))
+
+    # Function to project colors onto the closest trajectory segment
+    def _project(self, colors):
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        if len(self.knot_colors) == 1:
+            return np.full(len(colors), self.knot_thickness[0]), np.sqrt(((colors - self.knot_colors[0]) ** 2).sum(axis=1))
+
+        thickness = np.empty(len(colors))
+        distance = np.empty(len(colors))
+        for chunk_start in range(0, len(colors), 1 << 18):
+            chunk = colors[chunk_start:chunk_start + (1 << 18)]
+
+            # The segments around the one precomputed for the grid cell are projected onto exactly,
+            # so the cost per color does not depend on the size of the lookup table
+            cell = np.clip(((chunk - self.grid_low) / self.grid_step).astype(np.int64), 0, self.grid_segment.shape[0] - 1)
+            segment = self.grid_segment[cell[:, 0], cell[:, 1], cell[:, 2]]
+            segments = np.clip(segment[:, None] + np.arange(-4, 5), 0, len(self.start) - 1)
+            offset = chunk[:, None, :] - self.start[segments]
+            position = np.clip((offset * self.direction[segments]).sum(axis=2) / self.length[segments], 0, 1)
+            segment_distance = np.sqrt(((offset - position[..., None] * self.direction[segments]) ** 2).sum(axis=2))
+
+            closest = segment_distance.argmin(axis=1)
+            rows = np.arange(len(chunk))
+            segment = segments[rows, closest]
+            thickness[chunk_start:chunk_start + len(chunk)] = self.knot_thickness[segment] + position[rows, closest] * (self.knot_thickness[segment + 1] - self.knot_thickness[segment])
+            distance[chunk_start:chunk_start + len(chunk)] = segment_distance[rows, closest]
+        return thickness, distance
+
+    # Function to predict thickness and a confidence between 0 and 1 for many colors
+    def predict(self, colors):
+        thickness, distance = self._project(colors)
+        return thickness, np.exp(-0.5 * (distance / self.scale) ** 2)
+
+    # Function to save the fitted model
+    def save(self, file_name):
+        grid = {'grid_low': self.grid_low, 'grid_step': self.grid_step, 'grid_segment': self.grid_segment} if len(self.knot_colors) > 1 else {}
+        np.savez(file_name, knot_thickness=self.knot_thickness, knot_colors=self.knot_colors, scale=self.scale, color_space=self.color_space, **grid)
+
+    # Function to load a saved model
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as model:
+            grid = (model['grid_low'], model['grid_step'], model['grid_segment']) if 'grid_segment' in model else None
+            return cls(model['knot_thickness'], model['knot_colors'], model['scale'], str(model['color_space']), grid)
+
+# Function to map every pixel of an image to an interpolated thickness with a confidence
+def map_image_to_thickness_model(image, background_rgb, background_lab, models):
+    model_rgb, model_lab = models
+    unique_colors, index = distinct_image_colors(image)
+    normalized_rgb = normalize_color_array(unique_colors, background_rgb)
+    normalized_lab = normalize_color_array(rgb_to_lab_array(unique_colors, bgr=True, precise=False), background_lab)
+
+    thickness_rgb, confidence_rgb = model_rgb.predict(normalized_rgb)
+    thickness_lab, confidence_lab = model_lab.predict(normalized_lab)
+
+    return {
+        'thickness_rgb': thickness_rgb.astype(np.float32)[index],
+        'thickness_lab': thickness_lab.astype(np.float32)[index],
+        'confidence_rgb': confidence_rgb.astype(np.float32)[index],
+        'confidence_lab': confidence_lab.astype(np.float32)[index],
+    }
+
+# Class to read an image tile by tile, without loading it whole when it is a TIFF
+class TiledImage:
+    def __init__(self, image_path, tile_size=4096):
+        self.tile_size = tile_size
+        self.is_tiff = image_path.lower().endswith(('.tif', '.tiff'))
+
+        if self.is_tiff:
+            import tifffile
+
+            # Uncompressed TIFFs are memory-mapped, compressed ones are decoded per tile through zarr
+            try:
+                self.pixels = tifffile.memmap(image_path, mode='r')
+            except ValueError:
+                import zarr
+                self.pixels = zarr.open(tifffile.imread(image_path, aszarr=True), mode='r')
+                if isinstance(self.pixels, zarr.Group):
+                    self.pixels = self.pixels['0']
+        else:
+            self.pixels = cv2.imread(image_path)
+            if self.pixels is None:
+                raise ValueError(f"Failed to read image '{image_path}'.")
+
+        self.height, self.width = self.pixels.shape[:2]
+
+    # Function to read a region as an 8-bit BGR array, as cv2.imread would return it
+    def read(self, y0, y1, x0, x1):
+        region = np.asarray(self.pixels[y0:y1, x0:x1])
+        if not self.is_tiff:
+            return region
+        if region.dtype == np.uint16:
+            region = (region >> 8).astype(np.uint8)
+        if region.ndim == 2:
+            region = region[..., None].repeat(3, axis=2)
+        return np.ascontiguousarray(region[..., 2::-1])
+
+    # Function to iterate over the tiles covering a region of the image
+    def tiles(self, y0=0, y1=None, x0=0, x1=None):
+        y1 = self.height if y1 is None else min(y1, self.height)
+        x1 = self.width if x1 is None else min(x1, self.width)
+        for tile_y in range(y0, y1, self.tile_size):
+            for tile_x in range(x0, x1, self.tile_size):
+                tile_y1, tile_x1 = min(tile_y + self.tile_size, y1), min(tile_x + self.tile_size, x1)
+                yield tile_y, tile_x, self.read(tile_y, tile_y1, tile_x, tile_x1)
+
+# Function to compute the average color values of an image region tile by tile
+def tiled_roi_color_values(tiled_image, roi):
+    x, y, width, height = roi
+    sum_rgb = np.zeros(3)
+    sum_lab = np.zeros(3)
+    count = 0
+
+    # Tiles are clipped to the ROI, so pixels on tile borders are counted exactly once
+    for _, _, tile in tiled_image.tiles(y, y + height, x, x + width):
+        sum_rgb += tile.sum(axis=(0, 1))
+        sum_lab += cv2.cvtColor(tile, cv2.COLOR_BGR2LAB).sum(axis=(0, 1))
+        count += tile.shape[0] * tile.shape[1]
+
+    rgb = tuple(map(int, sum_rgb / count))
+    lab = tuple(map(int, sum_lab / count))
+    return rgb, lab
+
+# Function to map every pixel of a large image to thickness maps stored as .npy memory maps
+def map_tiled_image_to_thickness(tiled_image, background_rgb, background_lab, lookup_table, output_prefix, threshold=5):
+    if not isinstance(lookup_table, tuple):
+        lookup_table = LookupIndex(lookup_table, 'RGB'), LookupIndex(lookup_table, 'LAB')
+
+    outputs = {}
+    for tile_y, tile_x, tile in tiled_image.tiles():
+        # A pair of thickness models interpolates instead of matching the closest entries
+        if isinstance(lookup_table[0], ThicknessModel):
+            thickness_maps = map_image_to_thickness_model(tile, background_rgb, background_lab, lookup_table)
+        else:
+            thickness_maps = map_image_to_thickness(tile, background_rgb, background_lab, lookup_table, threshold)
+        for key, values in thickness_maps.items():
+            if key not in outputs:
+                outputs[key] = np.lib.format.open_memmap(f'{output_prefix}_{key}.npy', mode='w+', dtype=values.dtype, shape=(tiled_image.height, tiled_image.width))
+            outputs[key][tile_y:tile_y + tile.shape[0], tile_x:tile_x + tile.shape[1]] = values
+
+    for values in outputs.values():
+        values.flush()
+    return outputs
+
+# Function to compute the median and trimmed mean of each channel from its histogram
+def _histogram_statistics(histograms, trim=0.1):
+    count = histograms[0].sum()
+    cut = int(trim * count)
+    values = np.arange(histograms.shape[1])
+    cumulative = histograms.cumsum(axis=1)
+    previous = cumulative - histograms
+
+    # The median averages the two middle ranks, as np.median does
+    lower = (cumulative > (count - 1) // 2).argmax(axis=1)
+    upper = (cumulative > count // 2).argmax(axis=1)
+
+    # Counts of each value that remain after cutting `cut` pixels from both ends
+    kept = np.clip(cumulative, cut, count - cut) - np.clip(previous, cut, count - cut)
+    return (lower + upper) / 2, (kept * values).sum(axis=1) / (count - 2 * cut)
+
+# Class to compute ROI color statistics of a full-resolution image from summed-area tables
+class RoiStatistics:
+    def __init__(self, image, rois, trim=0.1):
+        # Tables only cover the bounding box of the ROIs, not the whole image
+        rois = np.asarray(rois, dtype=np.int64).reshape(-1, 4)
+        self.x0, self.y0 = int(rois[:, 0].min()), int(rois[:, 1].min())
+        x1, y1 = int((rois[:, 0] + rois[:, 2]).max()), int((rois[:, 1] + rois[:, 3]).max())
+        self.image = image[self.y0:y1, self.x0:x1]
+        self.lab = cv2.cvtColor(self.image, cv2.COLOR_BGR2LAB)
+        self.trim = trim
+
+        # Sums of any ROI then cost four lookups each
+        self.sum_rgb = cv2.integral(self.image, sdepth=cv2.CV_64F)
+        self.sum_lab = cv2.integral(self.lab, sdepth=cv2.CV_64F)
+
+    # Function to sum a summed-area table over an ROI
+    def _roi_sum(self, table, roi):
+        x, y, width, height = roi
+        x, y = x - self.x0, y - self.y0
+        return table[y + height, x + width] - table[y, x + width] - table[y + height, x] + table[y, x]
+
+    # Function to compute the average color values of an ROI, as _crop_color_values does
+    def color_values(self, roi):
+        count = roi[2] * roi[3]
+        rgb = tuple(map(int, self._roi_sum(self.sum_rgb, roi) / count))
+        lab = tuple(map(int, self._roi_sum(self.sum_lab, roi) / count))
+        return rgb, lab
+
+    # Function to compute the mean, median, standard deviation and trimmed mean of an ROI
+    def statistics(self, roi):
+        x, y, width, height = roi
+        x, y = x - self.x0, y - self.y0
+        count = width * height
+        values = np.arange(256)
+        statistics = {}
+        for color_space, image, sums in [('rgb', self.image, self.sum_rgb), ('lab', self.lab, self.sum_lab)]:
+            mean = self._roi_sum(sums, roi) / count
+
+            # Median, standard deviation and trimmed mean come from one histogram pass over the 8-bit crop
+            crop = image[y:y + height, x:x + width].reshape(-1, 3)
+            histograms = np.stack([np.bincount(crop[:, channel], minlength=256) for channel in range(3)])
+            median, trimmed_mean = _histogram_statistics(histograms, self.trim)
+            variance = np.maximum((histograms * values ** 2).sum(axis=1) / count - mean ** 2, 0)
+
+            statistics[f'mean_{color_space}'] = tuple(map(float, mean))
+            statistics[f'median_{color_space}'] = tuple(map(float, median))
+            statistics[f'std_{color_space}'] = tuple(map(float, np.sqrt(variance)))
+            statistics[f'trimmed_mean_{color_space}'] = tuple(map(float, trimmed_mean))
+        return statistics
+
+# Function to clip an ROI to the bounds of an image, rejecting ROIs that lie entirely outside of it
+def clip_roi(roi, width, height):
+    x, y, roi_width, roi_height = map(int, roi)
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + roi_width, width), min(y + roi_height, height)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"ROI {(x, y, roi_width, roi_height)} lies outside of the {width}x{height} image.")
+    return x0, y0, x1 - x0, y1 - y0
+
+# Function to compute the average color values of an image crop
+def _crop_color_values(image, roi):
+    x, y, width, height = roi
+    selected_area_rgb = image[y:y + height, x:x + width]
+    selected_area_lab = cv2.cvtColor(selected_area_rgb, cv2.COLOR_BGR2LAB)
+
+    rgb = tuple(map(int, np.mean(selected_area_rgb, axis=(0, 1))))
+    lab = tuple(map(int, np.mean(selected_area_lab, axis=(0, 1))))
+    return rgb, lab
+
+# Function to compute the average color values of an image region together with its color statistics
+def roi_color_statistics(image, roi):
+    with instrumentation.stage('roi_statistics', roi[2] * roi[3]):
+        statistics = RoiStatistics(image, [roi])
+        return statistics.color_values(roi) + (statistics.statistics(roi),)
+
+# Interval at which a file lock held by another process is tried again on Windows
+FILE_LOCK_POLL_SECONDS = 0.05
+
+# Class to hold an exclusive lock on a file across processes
+class FileLock:
+    def __init__(self, file_name):
+        self.lock_file = file_name + '.lock'
+
+    def __enter__(self):
+        self.file = open(self.lock_file, 'a+')
+        if os.name == 'nt':
+            # LK_LOCK gives up after ten seconds, while remaps can hold the lock much longer, so the lock is polled until it is free
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EACCES, errno.EDEADLOCK):
+                        raise
+                    time.sleep(FILE_LOCK_POLL_SECONDS)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if os.name == 'nt':
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+
+# Environment variable naming the file that receives stage timings, a ".prom" file gets Prometheus text format
+PROFILE_ENV = 'COLOR_TO_THICKNESS_PROFILE'
+
+# Environment variable with the run duration in seconds above which a cProfile dump is written
+PROFILE_THRESHOLD_ENV = 'COLOR_TO_THICKNESS_PROFILE_THRESHOLD'
+
+# Metrics written to Prometheus text files, with their help texts
+PROMETHEUS_METRICS = {
+    'color_to_thickness_runs_total': "Number of completed runs.",
+    'color_to_thickness_run_seconds_total': "Total duration of the runs in seconds.",
+    'color_to_thickness_stage_seconds_total': "Total duration of the stages in seconds.",
+    'color_to_thickness_stage_calls_total': "Number of times the stages were entered.",
+    'color_to_thickness_stage_items_total': "Number of items processed by the stages."
+}
+
+# Class to time the stages of a run and write the timings out when the run ends
+class Instrumentation:
+    def __init__(self):
+        # Each thread records its own run, so GUI worker threads do not mix their stages
+        self.local = threading.local()
+        # Only one cProfile profiler can be active at a time
+        self.profiler_lock = threading.Lock()
+        # A forked worker process must not inherit a lock held by its parent
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset_profiler_lock)
+
+    # Function to release the profiler in a new worker process
+    def reset_profiler_lock(self):
+        self.profiler_lock = threading.Lock()
+
+    # Function to get the stages of the current run, forked worker processes do not inherit the run of their parent
+    def current_stages(self):
+        run = getattr(self.local, 'run', None)
+        return run[1] if run is not None and run[0] == os.getpid() else None
+
+    # Function to record a run, its stages are written out when it ends
+    @contextmanager
+    def run(self, name):
+        output_file = os.environ.get(PROFILE_ENV)
+        # Runs started inside another run only add their stages to the outer one
+        if not output_file or self.current_stages() is not None:
+            yield
+            return
+
+        threshold = os.environ.get(PROFILE_THRESHOLD_ENV)
+        profiler = cProfile.Profile() if threshold and self.profiler_lock.acquire(blocking=False) else None
+        self.local.run = os.getpid(), {}
+        started = time.time()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.profiler_lock.release()
+            duration = time.perf_counter() - start
+            record = {
+                'run': name,
+                'pid': os.getpid(),
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                'duration_s': round(duration, 6),
+                'stages': self.local.run[1]
+            }
+            self.local.run = None
+
+            if profiler is not None and duration > float(threshold):
+                record['profile'] = f"{os.path.splitext(output_file)[0]}_{name}_{time.strftime('%Y%m%d_%H%M%S', time.localtime(started))}_{os.getpid()}.prof"
+                profiler.dump_stats(record['profile'])
+            self.write(output_file, record)
+
+    # Function to time one stage, the yielded dictionary lets the stage update its item count
+    @contextmanager
+    def stage(self, name, count=1):
+        stages = self.current_stages()
+        timing = {'count': count}
+        if stages is None:
+            # Stages outside of a run are recorded as runs of their own
+            if os.environ.get(PROFILE_ENV):
+                with self.run(name), self.stage(name, count) as timing:
+                    yield timing
+            else:
+                yield timing
+            return
+
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            stage = stages.setdefault(name, {'duration_s': 0.0, 'calls': 0, 'count': 0})
+            stage['duration_s'] = round(stage['duration_s'] + time.perf_counter() - start, 6)
+            stage['calls'] += 1
+            stage['count'] += timing['count']
+
+    # Function to append a run record to a JSON lines log or add it to the counters of a Prometheus text file
+    def write(self, output_file, record):
+        with FileLock(output_file):
+            if not output_file.endswith('.prom'):
+                with open(output_file, 'a') as file:
+                    file.write(json.dumps(record) + '\n')
+                return
+
+            # Counters are accumulated across runs and processes by reading back the previous values
+            samples = {}
+            if os.path.exists(output_file):
+                with open(output_file) as file:
+                    for line in file:
+                        if line.strip() and not line.startswith('#'):
+                            sample, value = line.rsplit(' ', 1)
+                            samples[sample] = float(value)
+
+            run = f'run="{record["run"]}"'
+            values = {f'color_to_thickness_runs_total{{{run}}}': 1, f'color_to_thickness_run_seconds_total{{{run}}}': record['duration_s']}
+            for stage, timing in record['stages'].items():
+                labels = f'{{{run},stage="{stage}"}}'
+                values[f'color_to_thickness_stage_seconds_total{labels}'] = timing['duration_s']
+                values[f'color_to_thickness_stage_calls_total{labels}'] = timing['calls']
+                values[f'color_to_thickness_stage_items_total{labels}'] = timing['count']
+            for sample, value in values.items():
+                samples[sample] = samples.get(sample, 0) + value
+
+            temporary_file = output_file + '.tmp'
+            with open(temporary_file, 'w') as file:
+                for metric, help_text in PROMETHEUS_METRICS.items():
+                    file.write(f"# HELP {metric} {help_text}\n# TYPE {metric} counter\n")
+                    for sample in sorted(sample for sample in samples if sample.split('{')[0] == metric):
+                        file.write(f"{sample} {samples[sample]:.15g}\n")
+            os.replace(temporary_file, output_file)
+
+# Instrumentation shared by the GUI and the batch mode, disabled unless the profile environment variable is set
+instrumentation = Instrumentation()
+
+# Class to store a substrate lookup table as an append-only CSV with a binary copy
+class LookupTableStore:
+    def __init__(self, substrate, directory=''):
+        self.csv_file = os.path.join(directory, f'lookup_table_{substrate}.csv')
+        self.binary_file = os.path.join(directory, f'lookup_table_{substrate}.bin')
+
+    # Function to check whether the lookup table exists
+    def exists(self):
+        return os.path.exists(self.csv_file)
+
+    # Function to check whether the binary copy holds the same rows as the CSV
+    def _binary_is_current(self):
+        return os.path.exists(self.binary_file) and os.path.getmtime(self.binary_file) >= os.path.getmtime(self.csv_file)
+
+    # Function to append one or many entries without rewriting the table
+    def append(self, entries):
+        entries = pd.DataFrame(entries, columns=LOOKUP_TABLE_COLUMNS).astype(np.float64)
+        with FileLock(self.csv_file):
+            if not self.exists():
+                entries.to_csv(self.csv_file, index=False)
+                entries.to_numpy().tofile(self.binary_file)
+                return
+
+            columns = list(pd.read_csv(self.csv_file, nrows=0).columns)
+            if not all(column in columns for column in LOOKUP_TABLE_COLUMNS):
+                raise ValueError(f"Mismatch in lookup table columns of '{self.csv_file}'.")
+
+            # Checked before writing, as appending to the CSV makes it the newest file
+            binary_is_current = self._binary_is_current()
+
+            with open(self.csv_file, 'rb+') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    file.write(b'\n')
+            entries.reindex(columns=columns).to_csv(self.csv_file, mode='a', header=False, index=False)
+
+            if binary_is_current:
+                with open(self.binary_file, 'ab') as file:
+                    entries.to_numpy().tofile(file)
+            elif os.path.exists(self.binary_file):
+                os.remove(self.binary_file)
+
+    # Function to bulk import the entries of another lookup table CSV
+    def import_csv(self, file_name):
+        self.append(pd.read_csv(file_name)[LOOKUP_TABLE_COLUMNS])
+
+    # Function to load the lookup table, from the binary copy when it is current
+    def load(self):
+        with FileLock(self.csv_file):
+            if not self.exists():
+                return pd.DataFrame(columns=LOOKUP_TABLE_COLUMNS, dtype=np.float64)
+            if self._binary_is_current():
+                return pd.DataFrame(np.fromfile(self.binary_file, dtype=np.float64).reshape(-1, len(LOOKUP_TABLE_COLUMNS)), columns=LOOKUP_TABLE_COLUMNS)
+
+            # The CSV is new or was edited by hand, so the binary copy is rebuilt
+            lookup_table = pd.read_csv(self.csv_file)[LOOKUP_TABLE_COLUMNS].astype(np.float64)
+            lookup_table.to_numpy().tofile(self.binary_file)
+            return lookup_table
+
+    # Function to get a signature that changes whenever the table file changes
+    def signature(self):
+        status = os.stat(self.csv_file)
+        return status.st_mtime_ns, status.st_size
+
+    # Function to export the lookup table with the CSV columns
+    def export_csv(self, file_name):
+        self.load().to_csv(file_name, index=False)
+
+# Class to keep parsed lookup tables and their indexes in memory between calls
+class LookupTableCache:
+    def __init__(self, max_bytes=LOOKUP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Function to get the cache entry of a substrate, reloading it if its file changed
+    def _entry(self, substrate):
+        store = LookupTableStore(substrate)
+        if not store.exists():
+            raise FileNotFoundError(f"Lookup table for substrate '{substrate}' not found.")
+
+        with self.lock:
+            signature = store.signature()
+            entry = self.entries.get(store.csv_file)
+            if entry is not None and entry['signature'] == signature:
+                self.entries.move_to_end(store.csv_file)
+                return entry
+
+            lookup_table = store.load()
+            indexes = LookupIndex(lookup_table, 'RGB'), LookupIndex(lookup_table, 'LAB')
+            entry = {
+                'signature': signature,
+                'lookup_table': lookup_table,
+                'indexes': indexes,
+                'models': None,
+                'nbytes': int(lookup_table.memory_usage(deep=True).sum()) + sum(index.nbytes for index in indexes)
+            }
+
+            # Least recently used entries are evicted until the new one fits
+            self.entries.pop(store.csv_file, None)
+            while self.entries and sum(cached['nbytes'] for cached in self.entries.values()) + entry['nbytes'] > self.max_bytes:
+                self.entries.popitem(last=False)
+            if entry['nbytes'] <= self.max_bytes:
+                self.entries[store.csv_file] = entry
+            return entry
+
+    # Function to get the lookup table of a substrate
+    def lookup_table(self, substrate):
+        return self._entry(substrate)['lookup_table']
+
+    # Function to get the RGB and LAB indexes of a substrate
+    def indexes(self, substrate):
+        return self._entry(substrate)['indexes']
+
+    # Function to get the RGB and LAB thickness models of a substrate, fitted on first use
+    def models(self, substrate):
+        entry = self._entry(substrate)
+        with self.lock:
+            if entry['models'] is None:
+                entry['models'] = ThicknessModel.fit(entry['lookup_table'], 'RGB'), ThicknessModel.fit(entry['lookup_table'], 'LAB')
+            return entry['models']
+
+    # Function to drop all cached lookup tables
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Lookup tables shared by the GUI, the batch workers and remapping
+lookup_table_cache = LookupTableCache()
+
+# Function to load the RGB and LAB indexes of a substrate lookup table
+def load_lookup_indexes(substrate):
+    with instrumentation.stage('load_lookup_table'):
+        return lookup_table_cache.indexes(substrate)
+
+# Function to parse stored color tuples such as "(0.5, 1.0, 0.8)" into an array
+def parse_color_tuples(column):
+    # Older results may hold NumPy reprs such as "(np.float64(0.5), ...)"
+    values = column.astype(str).str.replace(r'np\.float64\(([^)]*)\)', r'\1', regex=True)
+    return values.str.strip('()').str.split(',', expand=True).astype(float).to_numpy()
+
+# Columns of the results file, normalized colors and ROIs are stored as numbers
+RESULTS_COLUMNS = ['Image', 'Substrate', 'Method', 'X', 'Y', 'Width', 'Height'] + LOOKUP_TABLE_COLUMNS[:6] + ['Thickness_RGB [nm]', 'Thickness_LAB [nm]', 'Note_RGB', 'Note_LAB']
+
+# Columns identifying a result, rows with the same key describe the same measurement
+RESULTS_KEY_COLUMNS = RESULTS_COLUMNS[:13]
+
+# Columns holding the mapped thicknesses of a result
+RESULTS_VALUE_COLUMNS = RESULTS_COLUMNS[13:]
+
+# Methods mapping colors to thickness, closest lookup table entries or a fitted thickness model
+MAPPING_METHODS = ('Closest match', 'Interpolated')
+
+# Columns of the ROI a result was measured in, empty for colors entered by hand
+ROI_COLUMNS = ['X', 'Y', 'Width', 'Height']
+
+# Number of results rows from which remapping is spread across worker processes by default
+PARALLEL_REMAP_MIN_ROWS = 50000
+
+# Record of the results index, the hashes of the key and the value columns of one row
+RESULTS_INDEX_DTYPE = np.dtype([('key', '<u8'), ('value', '<u8')])
+
+# Function to build a frame with the columns and types of the results file from rows or another frame
+def results_frame(rows):
+    results = pd.DataFrame(rows).reindex(columns=RESULTS_COLUMNS).astype({column: 'Int64' for column in ROI_COLUMNS})
+    # Results written before the method was recorded were all closest matches
+    return results.assign(Method=results['Method'].fillna(MAPPING_METHODS[0]))
+
+# Function to read a results file with stable column types, whole or in chunks
+def read_results(results_file, chunksize=None):
+    dtype = {column: str for column in ['Image', 'Substrate', 'Method'] + RESULTS_VALUE_COLUMNS}
+    dtype.update({column: 'Int64' for column in ROI_COLUMNS})
+    # Empty thicknesses and notes stay empty strings so they hash like freshly mapped rows
+    na_values = {column: [''] for column in ROI_COLUMNS + LOOKUP_TABLE_COLUMNS[:6]}
+    return pd.read_csv(results_file, dtype=dtype, keep_default_na=False, na_values=na_values, chunksize=chunksize)
+
+# Function to convert results written by older versions, with color tuple columns or without the method, to the current columns
+def migrate_results_frame(results):
+    # The method of older rows is recovered from their notes
+    interpolated = results['Note_RGB'].astype(str).str.startswith(MAPPING_METHODS[1])
+    results = results.assign(Method=np.where(interpolated, MAPPING_METHODS[1], MAPPING_METHODS[0]))
+    if 'Average_RGB' not in results:
+        return results_frame(results)
+    colors = np.hstack([parse_color_tuples(results['Average_RGB']), parse_color_tuples(results['Average_LAB'])])
+    return results_frame(results.assign(**dict(zip(LOOKUP_TABLE_COLUMNS[:6], colors.T))))
+
+# Function to hash the key and the value columns of every results row
+def results_hashes(results):
+    keys = results[RESULTS_KEY_COLUMNS].astype({column: np.float64 for column in ROI_COLUMNS + LOOKUP_TABLE_COLUMNS[:6]})
+    keys = keys.astype({'Image': str, 'Substrate': str, 'Method': str}).round({column: 5 for column in LOOKUP_TABLE_COLUMNS[:6]})
+    values = results[RESULTS_VALUE_COLUMNS].astype(str)
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy(), pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+# Function to encode results as CSV lines without a header, together with their key and value hashes
+def encode_results_frame(results):
+    return (results.to_csv(header=False, index=False, lineterminator='\n'), *results_hashes(results))
+
+# Function to remap the thicknesses of a results frame, one batch per substrate and mapping method
+def remap_results_frame(results, indexes=None, substrates=None):
+    indexes = {} if indexes is None else indexes
+    columns = {column: results[column].to_numpy(dtype=object, copy=True) for column in RESULTS_VALUE_COLUMNS}
+
+    # Each substrate table is loaded once and queried for all of its rows together,
+    # interpolated rows are mapped again with the thickness models of the table
+    for (substrate, method), positions in results.groupby(['Substrate', 'Method'], sort=False).indices.items():
+        if substrates is not None and substrate not in substrates:
+            continue
+        if (substrate, method) not in indexes:
+            indexes[substrate, method] = lookup_table_cache.models(substrate) if method == MAPPING_METHODS[1] else load_lookup_indexes(substrate)
+        for color_space, color_columns, index in zip(['RGB', 'LAB'], [LOOKUP_TABLE_COLUMNS[:3], LOOKUP_TABLE_COLUMNS[3:6]], indexes[substrate, method]):
+            colors = results[color_columns].to_numpy(dtype=np.float64)[positions]
+            with instrumentation.stage('closest_color_search', len(positions)):
+                thickness, note = thickness_text(index, colors)
+            columns[f'Thickness_{color_space} [nm]'][positions] = thickness
+            columns[f'Note_{color_space}'][positions] = note
+
+    return results.assign(**columns)
+
+# Function to mark the rows of a results index that hold the latest value of their key
+def latest_results_rows(records):
+    if not len(records):
+        return np.zeros(0, dtype=bool)
+    order = np.argsort(records['key'], kind='stable')
+    keys, values = records['key'][order], records['value'][order]
+    first = np.concatenate([[True], keys[1:] != keys[:-1]])
+    last = np.append(first[1:], True)
+
+    # The latest row of a key is the last one that changed its value, so of identical rows the first one is kept
+    changed = first | np.concatenate([[True], values[1:] != values[:-1]])
+    last_change = np.maximum.accumulate(np.where(changed, np.arange(len(keys)), 0))
+    latest = np.zeros(len(keys), dtype=bool)
+    latest[order[last_change[last]]] = True
+    return latest
+
+# Class to store results rows in a CSV with an on-disk hash index for deduplication and upserts
+class ResultsStore:
+    def __init__(self, results_file='results.csv', flush_rows=1000):
+        self.results_file = results_file
+        self.index_file = results_file + '.idx'
+        self.remap_file = results_file + '.remap.json'
+        self.flush_rows = flush_rows
+        self.pending = []
+        # Sorted key hashes of the rows and the value hash of the latest row of each key, read from the index when first needed
+        self.latest_keys = self.latest_values = None
+        self.row_count = 0
+        self.index_status = None
+        # Stores are shared by the threads of a process, remap flushes while holding the lock
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    # Function to check whether the index holds the rows of the CSV
+    def _index_is_current(self):
+        if not os.path.exists(self.index_file) or os.path.getmtime(self.index_file) < os.path.getmtime(self.results_file):
+            return False
+        # Files indexed by older versions may still have to be converted to the current columns
+        with open(self.results_file, newline='') as file:
+            return file.readline().rstrip('\r\n') == ','.join(RESULTS_COLUMNS)
+
+    # Function to bring the in-memory index up to date with the files, called under the file lock
+    def _load_index(self):
+        if not os.path.exists(self.results_file):
+            self.latest_keys, self.latest_values = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+            self.row_count, self.index_status = 0, None
+            return
+        if not self._index_is_current():
+            self._rebuild_index()
+
+        # Rows appended by other processes are read from the end of the index, a rewritten index is read again
+        status = os.stat(self.index_file)
+        if self.latest_keys is None or self.index_status is None or status.st_ino != self.index_status[0] or status.st_size < self.index_status[1]:
+            self.latest_keys, self.latest_values = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+            self.row_count = 0
+        with open(self.index_file, 'rb') as file:
+            file.seek(self.row_count * RESULTS_INDEX_DTYPE.itemsize)
+            records = np.fromfile(file, dtype=RESULTS_INDEX_DTYPE)
+        self._update_latest(records['key'], records['value'])
+        self.row_count += len(records)
+        self.index_status = status.st_ino, status.st_size
+
+    # Function to rebuild the index of a new or hand-edited CSV, converting files with color tuple columns
+    def _rebuild_index(self, chunksize=100000):
+        columns = list(pd.read_csv(self.results_file, nrows=0).columns)
+        substrates = set()
+
+        # Function to convert the chunks of an older results file while collecting their substrates
+        def migrated_chunks(chunks):
+            for chunk in chunks:
+                substrates.update(chunk['Substrate'])
+                yield migrate_results_frame(chunk)
+
+        if 'Average_RGB' in columns:
+            self._rewrite(migrated_chunks(pd.read_csv(self.results_file, dtype=str, keep_default_na=False, chunksize=chunksize)))
+        elif columns == [column for column in RESULTS_COLUMNS if column != 'Method']:
+            self._rewrite(migrated_chunks(read_results(self.results_file, chunksize)))
+        elif columns != RESULTS_COLUMNS:
+            raise ValueError(f"Mismatch in results columns of '{self.results_file}'.")
+        else:
+            temporary_index = self.index_file + '.tmp'
+            with open(temporary_index, 'wb') as file:
+                for chunk in read_results(self.results_file, chunksize):
+                    substrates.update(chunk['Substrate'])
+                    self._index_records(*results_hashes(chunk)).tofile(file)
+            os.replace(temporary_index, self.index_file)
+
+        # Rows that were not added through the store may be mapped against any version of their lookup table
+        self._register_substrates(substrates, remapped=False)
+
+    # Function to build index records from key and value hashes
+    def _index_records(self, keys, values):
+        records = np.empty(len(keys), dtype=RESULTS_INDEX_DTYPE)
+        records['key'], records['value'] = keys, values
+        return records
+
+    # Function to write results chunks to a new CSV and index that replace the current ones
+    def _rewrite(self, chunks):
+        temporary_file, temporary_index = self.results_file + '.tmp', self.index_file + '.tmp'
+        try:
+            results_frame([]).to_csv(temporary_file, index=False)
+            with open(temporary_file, 'a', newline='') as file, open(temporary_index, 'wb') as index:
+                # Chunks are frames or CSV lines already encoded by remap worker processes
+                for chunk in chunks:
+                    text, keys, values = encode_results_frame(chunk) if isinstance(chunk, pd.DataFrame) else chunk
+                    with instrumentation.stage('write_results', len(keys)):
+                        file.write(text)
+                        file.flush()
+                        # The index is written after the CSV, so it is never older than the rows it describes
+                        self._index_records(keys, values).tofile(index)
+        except Exception:
+            for file_name in [temporary_file, temporary_index]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            raise
+
+        os.replace(temporary_file, self.results_file)
+        os.replace(temporary_index, self.index_file)
+        self.latest_keys = self.latest_values = self.index_status = None
+
+    # Function to read the lookup table signatures of the last remap, None for substrates not remapped yet
+    def _remap_state(self):
+        if not os.path.exists(self.remap_file):
+            return {}
+        with open(self.remap_file) as file:
+            return json.load(file)
+
+    # Function to save the lookup table signatures of the last remap
+    def _save_remap_state(self, state):
+        with open(self.remap_file, 'w') as file:
+            json.dump(state, file, indent=2)
+
+    # Function to mark substrates for the next remap, only new ones unless none of their rows can be trusted
+    def _register_substrates(self, substrates, remapped=True):
+        state = self._remap_state()
+        unregistered = {substrate for substrate in substrates if substrate not in state or not remapped}
+        if any(state.get(substrate, True) is not None for substrate in unregistered):
+            self._save_remap_state({**state, **dict.fromkeys(unregistered)})
+
+    # Function to buffer results rows, they are written once enough rows are pending, returning the number written
+    def add(self, rows):
+        with self.lock:
+            self.pending.extend(rows)
+            if len(self.pending) >= self.flush_rows:
+                return self.flush()
+        return 0
+
+    # Function to write the pending rows, skipping duplicates and replacing rows whose thicknesses changed
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+            results = results_frame(self.pending)
+            self.pending = []
+            return self._write(results)
+
+    # Function to add index records in row order to the latest values, returning which records change the value of their key
+    def _update_latest(self, keys, values):
+        if not len(keys):
+            return np.zeros(0, dtype=bool)
+        # Records are grouped by key in row order and compared with the record before them or the stored latest value
+        order = np.argsort(keys, kind='stable')
+        sorted_keys, sorted_values = keys[order], values[order]
+        starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+        previous = np.concatenate([sorted_values[:1], sorted_values[:-1]])
+        positions = np.searchsorted(self.latest_keys, sorted_keys[starts])
+        stored = positions < len(self.latest_keys)
+        stored[stored] = self.latest_keys[positions[stored]] == sorted_keys[starts[stored]]
+        previous[starts[stored]] = self.latest_values[positions[stored]]
+
+        # Of identical rows the first one is kept, a row with changed thicknesses replaces the earlier one
+        changed = np.empty(len(keys), dtype=bool)
+        changed[order] = sorted_values != previous
+        changed[order[starts[~stored]]] = True
+
+        # The last record of each key holds its latest value, new keys are inserted in sorted order
+        ends = np.append(starts[1:], len(keys)) - 1
+        self.latest_values[positions[stored]] = sorted_values[ends[stored]]
+        self.latest_keys = np.insert(self.latest_keys, positions[~stored], sorted_keys[starts[~stored]])
+        self.latest_values = np.insert(self.latest_values, positions[~stored], sorted_values[ends[~stored]])
+        return changed
+
+    # Function to write results rows that are not in the file yet, called under the store lock
+    def _write(self, results):
+        try:
+            return self._append(results)
+        except Exception:
+            # The index in memory may already list rows that were never written, so it is read again
+            self.latest_keys = self.latest_values = None
+            raise
+
+    # Function to append the new rows of a results frame to the CSV and its index
+    def _append(self, results):
+        keys, values = results_hashes(results)
+
+        with FileLock(self.results_file):
+            with instrumentation.stage('deduplicate', len(results)):
+                self._load_index()
+                # A replaced row stays in the file until the next remap but the index points to the new one
+                keep = self._update_latest(keys, values)
+            if not keep.any():
+                return 0
+
+            with instrumentation.stage('write_results', int(keep.sum())):
+                new_file = not os.path.exists(self.results_file)
+                if not new_file:
+                    with open(self.results_file, 'rb+') as file:
+                        file.seek(-1, os.SEEK_END)
+                        if file.read(1) != b'\n':
+                            file.write(b'\n')
+                results[keep].to_csv(self.results_file, mode='w' if new_file else 'a', header=new_file, index=False)
+                with open(self.index_file, 'wb' if new_file else 'ab') as file:
+                    self._index_records(keys[keep], values[keep]).tofile(file)
+                status = os.stat(self.index_file)
+                self.row_count, self.index_status = self.row_count + int(keep.sum()), (status.st_ino, status.st_size)
+
+            self._register_substrates(set(results['Substrate'][keep]))
+        return int(keep.sum())
+
+    # Function to remap the rows of substrates whose lookup table changed since the last remap and drop replaced rows
+    def remap(self, chunksize=100000, force=False, workers=1):
+        with self.lock:
+            self.flush()
+            return self._remap(chunksize, force, workers)
+
+    # Function to remap the results file, called under the store lock
+    def _remap(self, chunksize, force, workers):
+        if not os.path.exists(self.results_file):
+            raise FileNotFoundError(f"Results file '{self.results_file}' not found.")
+
+        with FileLock(self.results_file):
+            self._load_index()
+            state = self._remap_state()
+            signatures = {substrate: list(LookupTableStore(substrate).signature()) if LookupTableStore(substrate).exists() else None for substrate in state}
+            substrates = {substrate for substrate in state if force or state[substrate] != signatures[substrate]}
+
+            # Without a changed lookup table or a replaced row the file is already up to date
+            if not substrates and len(self.latest_keys) == self.row_count:
+                return 0
+
+            latest = latest_results_rows(np.fromfile(self.index_file, dtype=RESULTS_INDEX_DTYPE))
+            indexes = {}
+
+            # Function to read the latest rows in chunks
+            def latest_chunks():
+                chunks = iter(read_results(self.results_file, chunksize))
+                offset = 0
+                while True:
+                    with instrumentation.stage('read_results') as timing:
+                        chunk = next(chunks, None)
+                        timing['count'] = 0 if chunk is None else len(chunk)
+                    if chunk is None:
+                        return
+                    chunk, offset = chunk[latest[offset:offset + len(chunk)]], offset + len(chunk)
+                    yield chunk
+
+            # Small files are remapped in this process, as starting workers and loading their tables costs more
+            if workers > 1 and self.row_count >= PARALLEL_REMAP_MIN_ROWS:
+                # Workers are spawned, as forking the multi-threaded GUI process can deadlock them
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    self._rewrite(parallel_remap_chunks(executor, latest_chunks(), substrates, workers))
+            else:
+                self._rewrite(remap_results_frame(chunk, indexes, substrates) for chunk in latest_chunks())
+            self._save_remap_state(signatures)
+            self._load_index()
+            return self.row_count
+
+# Results stores of this process by results file, kept open so their row index is only read once
+_results_stores = {}
+_results_stores_lock = threading.Lock()
+
+# Function to get the shared store of a results file
+def results_store(results_file='results.csv'):
+    with _results_stores_lock:
+        path = os.path.abspath(results_file)
+        if path not in _results_stores:
+            # The store keeps the absolute path, so it still refers to its key after a change of directory
+            _results_stores[path] = ResultsStore(path)
+        return _results_stores[path]
+
+# Function to remap and encode one partition of results in a worker process, which keeps its own lookup tables
+def _remap_results_partition(results, remap):
+    with instrumentation.run('remap_partition'):
+        if remap:
+            results = remap_results_frame(results)
+        text, keys, values = encode_results_frame(results)
+        return text.split('\n')[:-1], keys, values
+
+# Function to submit the partitions of a results chunk, split by substrate and into at most one part per worker
+def _submit_remap_partitions(executor, results, substrates, workers):
+    size = max(1, -(-len(results) // workers))
+    partitions = []
+    for substrate, positions in results.groupby('Substrate', sort=False).indices.items():
+        for start in range(0, len(positions), size):
+            part = positions[start:start + size]
+            partitions.append((part, executor.submit(_remap_results_partition, results.iloc[part], substrate in substrates)))
+    return len(results), partitions
+
+# Function to merge the remapped partitions of a chunk back into the original row order
+def _merge_remap_partitions(count, partitions):
+    lines = np.empty(count, dtype=object)
+    keys, values = np.empty(count, dtype=np.uint64), np.empty(count, dtype=np.uint64)
+    for positions, future in partitions:
+        part_lines, part_keys, part_values = future.result()
+        if len(part_lines) != len(positions):
+            raise ValueError("Results containing line breaks cannot be remapped in parallel.")
+        lines[positions], keys[positions], values[positions] = part_lines, part_keys, part_values
+    return ''.join(line + '\n' for line in lines), keys, values
+
+# Function to remap results chunks across worker processes, reading the next chunk while the previous one is remapped
+def parallel_remap_chunks(executor, chunks, substrates, workers):
+    pending = deque()
+    for chunk in chunks:
+        pending.append(_submit_remap_partitions(executor, chunk, substrates, workers))
+        if len(pending) > 1:
+            yield _merge_remap_partitions(*pending.popleft())
+    while pending:
+        yield _merge_remap_partitions(*pending.popleft())
+
+# Function to remap a results file one chunk of rows at a time, across worker processes for large files if asked,
+# with the row index held as arrays of 16 bytes per row
+def remap_results_file(results_file='results.csv', chunksize=100000, force=False, workers=1):
+    with instrumentation.run('remap_results'):
+        return results_store(results_file).remap(chunksize, force, workers)
+
+# Function to estimate the background color of an image from its border or its most frequent color
+def estimate_background(image, method='border', border=0.05):
+    if method == 'border':
+        height, width = image.shape[:2]
+        margin = max(1, int(border * min(height, width)))
+        pixels = np.concatenate([image[:margin].reshape(-1, 3), image[-margin:].reshape(-1, 3), image[:, :margin].reshape(-1, 3), image[:, -margin:].reshape(-1, 3)])
+        lab = cv2.cvtColor(pixels[None], cv2.COLOR_BGR2LAB)[0]
+
+        # The median ignores flakes that touch the border
+        return tuple(map(int, np.median(pixels, axis=0))), tuple(map(int, np.median(lab, axis=0)))
+
+    # Otherwise the pixels of the most frequent color, quantized to 32 levels per channel, are averaged
+    quantized = (image >> 3).astype(np.int32)
+    codes = (quantized[..., 0] << 10) | (quantized[..., 1] << 5) | quantized[..., 2]
+    pixels = image[codes == np.bincount(codes.ravel(), minlength=1 << 15).argmax()]
+    lab = cv2.cvtColor(pixels[None], cv2.COLOR_BGR2LAB)[0]
+    return tuple(map(int, np.mean(pixels, axis=0))), tuple(map(int, np.mean(lab, axis=0)))
+
+# Function to find gold flakes as connected regions whose LAB color differs from the background
+def detect_flakes(image, background_lab, threshold=10, min_area=100, edge=2):
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB).astype(np.float32)
+    mask = (np.sqrt(((lab - np.float32(background_lab)) ** 2).sum(axis=2)) > threshold).astype(np.uint8)
+
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+    # Flakes are measured away from their edges, where they blend into the substrate
+    if edge:
+        labels[cv2.erode(mask, kernel, iterations=edge) == 0] = 0
+    measured = np.bincount(labels.ravel(), minlength=count)
+
+    flakes = [label for label in range(1, count) if stats[label, cv2.CC_STAT_AREA] >= min_area and measured[label] > 0]
+    rois = [tuple(map(int, stats[label, :4])) for label in flakes]
+    return labels, flakes, rois
+
+# Function to compute the average color values of every detected flake in one pass
+def flake_color_values(image, labels, flakes):
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+    flat_labels = labels.ravel()
+    count = np.bincount(flat_labels)
+    sums_rgb = np.stack([np.bincount(flat_labels, weights=image[..., channel].ravel(), minlength=len(count)) for channel in range(3)], axis=1)
+    sums_lab = np.stack([np.bincount(flat_labels, weights=lab[..., channel].ravel(), minlength=len(count)) for channel in range(3)], axis=1)
+    return [(tuple(map(int, sums_rgb[label] / count[label])), tuple(map(int, sums_lab[label] / count[label]))) for label in flakes]
+
+# Function to map normalized colors to thicknesses and notes with a lookup index or a thickness model
+def thickness_text(index, colors):
+    if not isinstance(index, ThicknessModel):
+        return index.query_text(colors)
+
+    # Thickness models give interpolated thicknesses with their confidence in the notes
+    thickness, confidence = index.predict(colors)
+    return np.round(thickness, 2), [f"Interpolated (confidence {value:.2f})" for value in confidence]
+
+# Function to map the average colors of flakes to results rows
+def flake_results(image_name, substrate, background_rgb, background_lab, flake_colors, indexes, rois=None):
+    if not flake_colors:
+        return []
+
+    normalized_rgb = normalize_color_array([rgb for rgb, _ in flake_colors], background_rgb)
+    normalized_lab = normalize_color_array([lab for _, lab in flake_colors], background_lab)
+
+    thickness_rgb, note_rgb = thickness_text(indexes[0], normalized_rgb)
+    thickness_lab, note_lab = thickness_text(indexes[1], normalized_lab)
+
+    method = MAPPING_METHODS[1] if isinstance(indexes[0], ThicknessModel) else MAPPING_METHODS[0]
+    rois = [(None,) * 4] * len(flake_colors) if rois is None else rois
+    return [{
+        'Image': image_name,
+        'Substrate': substrate,
+        'Method': method,
+        **dict(zip(ROI_COLUMNS, rois[i])),
+        **dict(zip(LOOKUP_TABLE_COLUMNS[:6], map(float, np.concatenate([normalized_rgb[i], normalized_lab[i]])))),
+        'Thickness_RGB [nm]': thickness_rgb[i],
+        'Thickness_LAB [nm]': thickness_lab[i],
+        'Note_RGB': note_rgb[i],
+        'Note_LAB': note_lab[i]
+    } for i in range(len(flake_colors))]
+
+# Function to add results rows to the results file, returning how many were new or changed
+def append_results(rows, results_file='results.csv'):
+    store = results_store(results_file)
+    with store.lock:
+        return store.add(rows) + store.flush()
+
+# Function to add one calibration point to the lookup table of a substrate
+def add_lookup_table_entry(substrate, gold_flake_rgb, gold_flake_lab, background_rgb, background_lab, thickness):
+    with instrumentation.run('create_lookup_table_entry'):
+        with instrumentation.stage('color_conversion'):
+            normalized_rgb, normalized_lab = normalize_colors(gold_flake_rgb, gold_flake_lab, background_rgb, background_lab)
+        store = LookupTableStore(substrate)
+        with instrumentation.stage('write_lookup_table'):
+            store.append([list(normalized_rgb) + list(normalized_lab) + [thickness]])
+    return store.csv_file
+
+# Function to map one gold flake color to thickness and append the result
+def map_colors_to_thickness(image_name, substrate, gold_flake_rgb, gold_flake_lab, background_rgb, background_lab, roi=None, results_file='results.csv'):
+    with instrumentation.run('map_image_to_lookup_table'):
+        index_rgb, index_lab = load_lookup_indexes(substrate)
+        with instrumentation.stage('color_conversion'):
+            normalized_rgb, normalized_lab = normalize_colors(gold_flake_rgb, gold_flake_lab, background_rgb, background_lab)
+
+        with instrumentation.stage('closest_color_search', 2):
+            thickness_rgb, match_type_rgb = find_closest_color(normalized_rgb, index_rgb, 'RGB')
+            thickness_lab, match_type_lab = find_closest_color(normalized_lab, index_lab, 'LAB')
+
+        result = {
+            'Image': image_name,
+            'Substrate': substrate,
+            'Method': MAPPING_METHODS[0],
+            **dict(zip(ROI_COLUMNS, (None,) * 4 if roi is None else roi)),
+            **dict(zip(LOOKUP_TABLE_COLUMNS[:6], normalized_rgb + normalized_lab)),
+            'Thickness_RGB [nm]': thickness_rgb,
+            'Thickness_LAB [nm]': thickness_lab,
+            'Note_RGB': match_type_rgb,
+            'Note_LAB': match_type_lab
+        }
+        append_results([result], results_file)
+    return result
+
+# Function to detect and map all flakes of an image and append the results
+def map_image_flakes(image_path, substrate, results_file='results.csv'):
+    with instrumentation.run('map_image_flakes'):
+        indexes = load_lookup_indexes(substrate)
+        with instrumentation.stage('imread'):
+            image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Failed to read image '{image_path}'.")
+
+        with instrumentation.stage('detect_flakes', image.shape[0] * image.shape[1]):
+            background_rgb, background_lab = estimate_background(image)
+            labels, flakes, rois = detect_flakes(image, background_lab)
+            flake_colors = flake_color_values(image, labels, flakes)
+
+        image_name = os.path.splitext(os.path.basename(image_path))[0]
+        with instrumentation.stage('closest_color_search', len(flake_colors)):
+            rows = flake_results(image_name, substrate, background_rgb, background_lab, flake_colors, indexes, rois)
+        if rows:
+            append_results(rows, results_file)
+    return rows
+
+# Function to collect image files from directories and glob patterns
+def collect_images(patterns):
+    image_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            image_paths += sorted(os.path.join(pattern, name) for name in os.listdir(pattern) if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            # Patterns such as 'images/*' also match the sidecar files, which are left out
+            image_paths += sorted(path for path in glob.glob(pattern) if path.lower().endswith(IMAGE_EXTENSIONS))
+    return image_paths
+
+# Function to read the background and flake ROIs of an image from its sidecar file
+def load_sidecar_rois(image_path):
+    base_path = os.path.splitext(image_path)[0]
+
+    # JSON: {"background": [x, y, width, height], "flakes": [[x, y, width, height], ...]}
+    if os.path.exists(base_path + '.json'):
+        with open(base_path + '.json') as file:
+            rois = json.load(file)
+        return tuple(rois['background']), [tuple(roi) for roi in rois['flakes']]
+
+    # CSV: one row per ROI with columns ROI (background/flake), X, Y, Width, Height
+    if os.path.exists(base_path + '.csv'):
+        rois = pd.read_csv(base_path + '.csv')
+        coordinates = rois[['X', 'Y', 'Width', 'Height']].astype(int)
+        background = coordinates[rois['ROI'] == 'background']
+        if len(background) != 1:
+            raise ValueError(f"Expected exactly one background ROI in '{base_path}.csv'.")
+        flakes = coordinates[rois['ROI'] == 'flake']
+        return tuple(background.iloc[0]), [tuple(roi) for roi in flakes.itertuples(index=False)]
+
+    raise FileNotFoundError(f"No ROI sidecar file found for '{image_path}'.")
+
+# Lookup table indexes of a batch worker process, keyed by color space
+_worker_indexes = {}
+
+# Function to load the lookup table once per batch worker process
+def _init_batch_worker(substrate):
+    _worker_indexes['RGB'], _worker_indexes['LAB'] = load_lookup_indexes(substrate)
+
+# Function to map the ROIs of one image to results rows
+def map_image_rois(image_path, substrate, thickness_map_directory=None, auto=False, min_flake_area=100, interpolate=False):
+    with instrumentation.run('map_image_rois'):
+        with instrumentation.stage('imread'):
+            image = TiledImage(image_path)
+        image_name = os.path.splitext(os.path.basename(image_path))[0]
+        indexes = lookup_table_cache.models(substrate) if interpolate else (_worker_indexes['RGB'], _worker_indexes['LAB'])
+
+        if auto:
+            # Automatic detection needs the whole image in memory, so TIFFs too large for it are refused
+            if image.is_tiff and image.height * image.width > AUTO_MAX_PIXELS:
+                raise ValueError(f"Image of {image.height * image.width} pixels exceeds the {AUTO_MAX_PIXELS} pixels that automatic detection reads into memory, "
+                                 "use a sidecar file with the ROIs instead or raise COLOR_TO_THICKNESS_AUTO_MAX_PIXELS.")
+            with instrumentation.stage('detect_flakes', image.height * image.width):
+                pixels = image.read(0, image.height, 0, image.width)
+                background_rgb, background_lab = estimate_background(pixels)
+                labels, flakes, flake_rois = detect_flakes(pixels, background_lab, min_area=min_flake_area)
+                flake_colors = flake_color_values(pixels, labels, flakes)
+        else:
+            background_roi, flake_rois = load_sidecar_rois(image_path)
+            # ROIs reaching past the image edge are measured and recorded on their part inside the image
+            background_roi = clip_roi(background_roi, image.width, image.height)
+            flake_rois = [clip_roi(roi, image.width, image.height) for roi in flake_rois]
+
+            # Summed-area tables make each ROI cost O(1) but are only worth building
+            # when the ROIs cover more pixels than their bounding box, i.e. when they overlap
+            rois = np.asarray([background_roi] + flake_rois, dtype=np.int64)
+            roi_area = int((rois[:, 2] * rois[:, 3]).sum())
+            bounding_box_area = int(((rois[:, 0] + rois[:, 2]).max() - rois[:, 0].min()) * ((rois[:, 1] + rois[:, 3]).max() - rois[:, 1].min()))
+            with instrumentation.stage('roi_statistics', len(rois)):
+                if image.is_tiff:
+                    color_values = lambda roi: tiled_roi_color_values(image, roi)
+                elif roi_area > bounding_box_area:
+                    color_values = RoiStatistics(image.pixels, rois).color_values
+                else:
+                    color_values = lambda roi: _crop_color_values(image.pixels, roi)
+                background_rgb, background_lab = color_values(background_roi)
+                flake_colors = [color_values(roi) for roi in flake_rois]
+
+        if thickness_map_directory:
+            with instrumentation.stage('thickness_map', image.height * image.width):
+                map_tiled_image_to_thickness(image, background_rgb, background_lab, indexes, os.path.join(thickness_map_directory, image_name))
+
+        with instrumentation.stage('closest_color_search', len(flake_colors)):
+            return flake_results(image_name, substrate, background_rgb, background_lab, flake_colors, indexes, flake_rois)
+
+# Function to run the batch mapping from the command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map the colors of gold flakes in a batch of images to thickness.")
+    parser.add_argument('images', nargs='+', help="image files, directories or glob patterns")
+    parser.add_argument('--substrate', required=True, choices=SUBSTRATES, help="substrate lookup table to map against")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--results', default='results.csv', help="results file to append to")
+    parser.add_argument('--auto', action='store_true', help="detect the background and the flakes automatically instead of reading sidecar files")
+    parser.add_argument('--min-flake-area', type=int, default=100, help="smallest flake kept by automatic detection, in pixels")
+    parser.add_argument('--interpolate', action='store_true', help="interpolate thickness with a fitted model instead of using the closest lookup table entries")
+    parser.add_argument('--thickness-maps', metavar='DIRECTORY', help="also write per-pixel thickness maps as .npy files to this directory")
+    parser.add_argument('--profile', metavar='FILE', help="write stage timings to this JSON lines log, or to a Prometheus text file if it ends in .prom")
+    parser.add_argument('--profile-threshold', type=float, metavar='SECONDS', help="also dump a cProfile of every run that takes longer than this")
+    args = parser.parse_args(argv)
+
+    # The worker processes inherit the instrumentation settings through the environment
+    if args.profile:
+        os.environ[PROFILE_ENV] = args.profile
+    if args.profile_threshold is not None:
+        os.environ[PROFILE_THRESHOLD_ENV] = str(args.profile_threshold)
+
+    if not LookupTableStore(args.substrate).exists():
+        parser.error(f"Lookup table for substrate '{args.substrate}' not found.")
+
+    image_paths = collect_images(args.images)
+    if not image_paths:
+        parser.error("No images found.")
+
+    if args.thickness_maps:
+        os.makedirs(args.thickness_maps, exist_ok=True)
+
+    failed = 0
+    with instrumentation.run('batch'), results_store(args.results) as store, ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker, initargs=(args.substrate,)) as executor:
+        futures = [executor.submit(map_image_rois, image_path, args.substrate, args.thickness_maps, args.auto, args.min_flake_area, args.interpolate) for image_path in image_paths]
+
+        # Rows are buffered in input order as each image is done and written in batches
+        for image_path, future in zip(image_paths, futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                print(f"Skipping '{image_path}': {e}", file=sys.stderr)
+                failed += 1
+                continue
+            store.add(rows)
+            print(f"{image_path}: {len(rows)} ROI(s) mapped")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
+
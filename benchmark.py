@@ -0,0 +1,269 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import ColorToThicknessCore as ctt
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Startup time target in milliseconds for starting Python and importing the application
+STARTUP_TARGET_MS = 500
+
+# Fewest timed calls for which latency percentiles are reported instead of the minimum, median and maximum
+PERCENTILE_MIN_CALLS = 10
+
+# Modules that must not be imported until the application needs them
+HEAVY_MODULES = ('pandas', 'cv2', 'scipy', 'tkinter')
+
+# Code that imports the application and reports which heavy modules were loaded
+STARTUP_CODE = ("import sys; import ColorToThickness; "
+                f"print(','.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))")
+
+# Function to generate a synthetic lookup table along a smooth color trajectory
+def synthetic_lookup_table(rows, rng):
+    thickness = np.sort(rng.uniform(10, 300, rows))
+    phase = thickness / 300 * 2 * np.pi
+    rgb = np.stack([1 + 0.4 * np.sin(phase), 1 + 0.3 * np.cos(1.3 * phase), 0.8 + 0.4 * phase / (2 * np.pi)], axis=1)
+    lab = np.stack([1 + 0.2 * np.cos(phase), 1 + 0.1 * np.sin(phase), 1 + 0.3 * np.sin(0.7 * phase)], axis=1)
+    colors = np.round(np.hstack([rgb, lab]) + rng.normal(0, 0.01, (rows, 6)), 5)
+
+    lookup_table = pd.DataFrame(colors, columns=ctt.LOOKUP_TABLE_COLUMNS[:6])
+    lookup_table['Thickness [nm]'] = np.round(thickness)
+    return lookup_table
+
+# Function to generate a synthetic micrograph of flakes on a noisy substrate
+def synthetic_image(megapixels, rng, flakes=50):
+    width = int(np.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    background = np.array([140, 130, 120])
+    image = np.clip(background + rng.normal(0, 2, (height, width, 3)), 0, 255).astype(np.uint8)
+
+    for _ in range(flakes):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        size = rng.integers(max(4, width // 80), max(8, width // 20))
+        color = np.clip(background * rng.uniform(0.5, 1.5, 3), 0, 255)
+        image[y:y + size, x:x + size] = color.astype(np.uint8)
+    return image, tuple(map(int, background))
+
+# Function to summarize latencies in milliseconds, with percentiles only when there are enough of them
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) < PERCENTILE_MIN_CALLS:
+        return {'min': float(latencies.min()), 'median': float(np.median(latencies)), 'max': float(latencies.max())}
+    return {f'p{percentile}': float(np.percentile(latencies, percentile)) for percentile in (50, 90, 99)}
+
+# Function to measure how much the peak resident memory grows during one call, in a forked process
+# so that the allocations of OpenCV and other native code, which tracemalloc misses, are counted too
+def peak_rss_growth_mb(function):
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_end)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            function()
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_end, str(after - before).encode())
+        finally:
+            os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as file:
+        growth = file.read()
+    os.waitpid(pid, 0)
+    if not growth:
+        return None
+    # The peak resident memory is reported in bytes on macOS and in kilobytes elsewhere
+    return int(growth) / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+# Function to time repeated calls and measure the peak memory of more calls
+def measure(function, repeat, items=1):
+    # One untimed call warms up caches and lazy initialization
+    function()
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+
+    # Memory is traced in a separate call so tracing does not slow down the timed ones
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'calls': repeat,
+        'items_per_call': items,
+        'throughput_per_s': items * repeat / sum(latencies),
+        'latency_ms': latency_summary(latencies),
+        'peak_memory_mb': peak / 2 ** 20,
+        'peak_rss_growth_mb': peak_rss_growth_mb(function)
+    }
+
+# Function to benchmark the single-color functions used by the GUI
+def benchmark_single_color(rng, repeat):
+    # Inputs are cycled, as measure() makes more calls than it times
+    colors = [tuple(map(int, color)) for color in rng.integers(0, 256, (repeat, 3))]
+    colors_iter = itertools.cycle(colors * 2)
+    results = {'rgb_to_lab': measure(lambda: ctt.rgb_to_lab(next(colors_iter)), repeat)}
+
+    colors_iter = itertools.cycle(colors * 2)
+    results['normalize_colors'] = measure(lambda: ctt.normalize_colors(next(colors_iter), (100, 130, 120), (140, 130, 120), (150, 128, 128)), repeat)
+    return results
+
+# Function to benchmark the array color functions
+def benchmark_color_arrays(rng, repeat, count=1000000):
+    colors = rng.integers(0, 256, (count, 3))
+    return {
+        'rgb_to_lab_array': measure(lambda: ctt.rgb_to_lab_array(colors), repeat, count),
+        'normalize_color_array': measure(lambda: ctt.normalize_color_array(colors, (140, 130, 120)), repeat, count)
+    }
+
+# Function to benchmark closest color queries for one lookup table size
+def benchmark_lookup_table(lookup_table, rng, repeat, heavy_repeat, queries=100000):
+    colors = lookup_table[['R', 'G', 'B']].to_numpy() + rng.normal(0, 0.02, (len(lookup_table), 3))
+    colors = colors[rng.integers(0, len(colors), queries)]
+    single_colors = itertools.cycle([tuple(color) for color in colors[:repeat * 2]])
+    index = ctt.LookupIndex(lookup_table, 'RGB')
+    model = ctt.ThicknessModel.fit(lookup_table, 'RGB')
+    batch_repeat = max(1, repeat // 50)
+
+    return {
+        'LookupIndex': measure(lambda: ctt.LookupIndex(lookup_table, 'RGB'), batch_repeat, len(lookup_table)),
+        'find_closest_color': measure(lambda: ctt.find_closest_color(next(single_colors), index, 'RGB'), repeat),
+        'find_closest_colors': measure(lambda: index.query(colors), batch_repeat, queries),
+        'ThicknessModel.fit': measure(lambda: ctt.ThicknessModel.fit(lookup_table, 'RGB'), heavy_repeat, len(lookup_table)),
+        'ThicknessModel.predict': measure(lambda: model.predict(colors), batch_repeat, queries)
+    }
+
+# Function to benchmark appending calibration entries and remapping a results file
+def benchmark_storage(lookup_table, rng, repeat, heavy_repeat, results_rows):
+    store = ctt.LookupTableStore('Benchmark')
+    store.append(lookup_table)
+    entries = itertools.cycle(lookup_table.sample(repeat * 2, replace=True, random_state=0).to_numpy()[:, None, :])
+    results = {'create_lookup_table_entry': measure(lambda: store.append(next(entries)), repeat)}
+
+    colors = lookup_table[ctt.LOOKUP_TABLE_COLUMNS[:6]].to_numpy()[rng.integers(0, len(lookup_table), results_rows)]
+    rows = pd.DataFrame(colors, columns=ctt.LOOKUP_TABLE_COLUMNS[:6]).assign(
+        Image=[f'image_{row}' for row in range(results_rows)], Substrate='Benchmark', X=0, Y=0, Width=10, Height=10,
+        **{'Thickness_RGB [nm]': '', 'Thickness_LAB [nm]': '', 'Note_RGB': '', 'Note_LAB': ''}
+    ).to_dict('records')
+
+    # Every call after the first one only finds duplicates, so the second measures the index lookups
+    for file_name in ['results_benchmark.csv', 'results_benchmark.csv.idx', 'results_benchmark.csv.remap.json']:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    results['append_results'] = measure(lambda: ctt.append_results(rows, 'results_benchmark.csv'), heavy_repeat, results_rows)
+
+    results['remap_results'] = measure(lambda: ctt.remap_results_file('results_benchmark.csv', force=True, workers=1), heavy_repeat, results_rows)
+    results['remap_results_parallel'] = measure(lambda: ctt.remap_results_file('results_benchmark.csv', force=True, workers=os.cpu_count()), heavy_repeat, results_rows)
+    results['remap_results_unchanged'] = measure(lambda: ctt.remap_results_file('results_benchmark.csv'), heavy_repeat, results_rows)
+    return results
+
+# Function to benchmark whole-image mapping for one image size
+def benchmark_image(megapixels, indexes, rng, repeat):
+    image, background = synthetic_image(megapixels, rng)
+    background_lab = tuple(map(int, ctt.rgb_to_lab_array(background, bgr=True, precise=False)[0]))
+    pixels = image.shape[0] * image.shape[1]
+
+    return {
+        'map_image_to_thickness': measure(lambda: ctt.map_image_to_thickness(image, background, background_lab, indexes), repeat, pixels),
+        'detect_flakes': measure(lambda: ctt.detect_flakes(image, background_lab), repeat, pixels)
+    }
+
+# Function to measure the startup time of the application and profile its imports
+def benchmark_startup(repeat, top=10):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_CODE], cwd=directory, capture_output=True, text=True, check=True)
+        latencies.append(time.perf_counter() - start)
+
+    # The import profile lists the self and cumulative time of every imported module in microseconds
+    imports = []
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            imports.append((fields[2].strip(), int(fields[1].strip()) / 1000))
+    imports.sort(key=lambda item: item[1], reverse=True)
+
+    # The first run warms up the file system cache and is not counted
+    latencies = np.array(latencies[1:])
+    return {
+        'calls': repeat,
+        'latency_ms': latency_summary(latencies),
+        'target_ms': STARTUP_TARGET_MS,
+        'within_target': bool(np.percentile(latencies, 50) * 1000 <= STARTUP_TARGET_MS),
+        'heavy_modules_loaded': [module for module in process.stdout.strip().split(',') if module],
+        'slowest_imports_ms': dict(imports[:top])
+    }
+
+# Function to run all benchmarks and write the report as JSON
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ColorToThickness on synthetic lookup tables and images.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000, 100000], help="lookup table sizes")
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 10], help="synthetic image sizes")
+    parser.add_argument('--repeat', type=int, default=200, help="timed calls per latency benchmark")
+    parser.add_argument('--heavy-repeat', type=int, default=3, help="timed calls per image, remap, storage and model fitting benchmark")
+    parser.add_argument('--results-rows', type=int, default=100000, help="rows of the synthetic results file")
+    parser.add_argument('--startup-repeat', type=int, default=10, help="timed application startups")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument('--output', default='bench_output.json', help="JSON report file")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    output = os.path.abspath(args.output)
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'arguments': vars(args),
+        'startup': benchmark_startup(args.startup_repeat),
+        'single_color': benchmark_single_color(rng, args.repeat),
+        'color_arrays': benchmark_color_arrays(rng, max(1, args.repeat // 50)),
+        'lookup_tables': {},
+        'storage': {},
+        'images': {}
+    }
+
+    # Lookup tables and results files are written to a scratch directory
+    with tempfile.TemporaryDirectory() as directory:
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        try:
+            for rows in args.rows:
+                lookup_table = synthetic_lookup_table(rows, rng)
+                report['lookup_tables'][rows] = benchmark_lookup_table(lookup_table, rng, args.repeat, args.heavy_repeat)
+                report['storage'][rows] = benchmark_storage(lookup_table, rng, args.repeat, args.heavy_repeat, args.results_rows)
+                os.remove('lookup_table_Benchmark.csv')
+                os.remove('lookup_table_Benchmark.bin')
+                ctt.lookup_table_cache.clear()
+
+            indexes = ctt.LookupIndex(lookup_table, 'RGB'), ctt.LookupIndex(lookup_table, 'LAB')
+            for megapixels in args.megapixels:
+                report['images'][megapixels] = benchmark_image(megapixels, indexes, rng, args.heavy_repeat)
+        finally:
+            os.chdir(working_directory)
+
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Benchmark report written to '{output}'.")
+
+if __name__ == "__main__":
+    main()